@@ -4,9 +4,20 @@ Auto-login script for NUJS-CAMPUS WiFi (Sophos/Cyberoam captive portal).
 Credentials stored in macOS Keychain.
 """
 
+import argparse
+import fcntl
+import hashlib
+import json
+import os
 import subprocess
 import sys
 import time
+import queue
+import random
+import re
+import socket
+import struct
+import threading
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -17,8 +28,97 @@ PORTAL_BASE = "http://172.24.66.1:8090"
 KEYCHAIN_SERVICE = "nujs-wifi-autologin"
 USERNAME = "REPLACE_WITH_YOUR_USERNAME"
 # Password is stored in macOS Keychain (run setup.sh to configure)
+# Optional: address ranges campus clients are known to get. An address on one
+# is always treated as campus; any other address is still probed unless the
+# script has learned that its network has no portal.
+CAMPUS_NETWORKS = []
 # -----------------------
 
+TARGET_SSID = "NUJS-CAMPUS WiFi"
+# Wi-Fi interface whose network name is checked (en0 on MacBooks)
+WIFI_INTERFACE = "en0"
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
+# Networks (the /24 our address is on) where the portal didn't answer. After
+# NETWORK_NEGATIVE_MISSES visits in a row like that, triggers there stop
+# before any probe for NETWORK_NEGATIVE_TTL seconds. Networks where it did
+# answer are marked as campus, with the portal their captive redirect
+# pointed at (if not PORTAL_BASE) for PORTAL_CACHE_TTL seconds.
+NETWORKS_FILE = os.path.join(SCRIPT_DIR, "networks.json")
+NETWORK_NEGATIVE_MISSES = 3
+NETWORK_NEGATIVE_TTL = 24 * 3600
+# A captive redirect only counts as the portal if it looks like Sophos (its
+# port or its login page), and is only used on the NUJS network (its SSID,
+# or a network where the portal answered before) once it answered like Sophos
+PORTAL_CACHE_TTL = 7 * 24 * 3600
+SOPHOS_PORT = 8090
+SOPHOS_PAGE = "/httpclient.html"
+META_REFRESH = re.compile(
+    r"""<meta[^>]+http-equiv=["']?refresh["']?[^>]*?content=["']?[^"'>]*?url=([^"'>\s]+)""",
+    re.IGNORECASE)
+# One login run at a time across the daemon, manual and test runs. A run that
+# finds another in flight waits up to RUN_LOCK_WAIT seconds for it, and if it
+# finished on the same network, doesn't repeat it (see LAST_RUN_FILE).
+RUN_LOCK_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-login.lock")
+LAST_RUN_FILE = os.path.join(SCRIPT_DIR, "last-run.json")
+RUN_LOCK_WAIT = 120
+
+CAPTIVE_PROBE_URL = "http://captive.apple.com/hotspot-detect.html"
+# (url, expected HTTP status, expected body text) - any one answering as expected means we're online
+CONNECTIVITY_PROBES = [
+    (CAPTIVE_PROBE_URL, 200, "Success"),
+    ("http://connectivitycheck.gstatic.com/generate_204", 204, ""),
+    ("http://www.msftconnecttest.com/connecttest.txt", 200, "Microsoft Connect Test"),
+]
+PROBE_TIMEOUT = 5
+# Known addresses of probe hosts: the probe goes straight to the address with
+# the name in the Host header, so it neither waits on nor trusts the network's
+# DNS (often intercepted or hijacked behind a captive portal)
+PINNED_ADDRESSES = {
+    "www.msftconnecttest.com": ["13.107.4.52"],
+}
+# Portal readiness wait: TCP-connect probes starting at PORTAL_WAIT_FIRST seconds
+# apart, doubling (with jitter) up to PORTAL_WAIT_MAX, giving up after the deadline
+PORTAL_WAIT_DEADLINE = 30
+PORTAL_WAIT_FIRST = 0.2
+PORTAL_WAIT_MAX = 3
+# Daemon mode: how often to look for network changes, and how often to re-check
+# the session even when nothing changed
+DAEMON_POLL = 2
+DAEMON_RECHECK = 60
+# Keepalive: idle seconds before the portal drops a session. After its own
+# login the daemon sends a live request every half timeout, retrying after
+# KEEPALIVE_RETRY seconds when the request itself fails
+SESSION_TIMEOUT = 360
+KEEPALIVE_JITTER = 0.1
+KEEPALIVE_RETRY = 15
+# The daemon keeps the Keychain password in memory this long before asking
+# the Keychain again; a "wrong password" reply drops it at once
+PASSWORD_CACHE_TTL = 12 * 3600
+# Portal messages meaning the stored password is wrong
+WRONG_PASSWORD_MESSAGES = ("invalid user name/password", "invalid username", "incorrect password")
+# After a failed login the same password isn't sent again until its back-off
+# (in BACKOFF_FILE, removed by setup.sh) runs out. A refusal that retrying
+# can't fix waits as long as TERMINAL_BACKOFF says; any other failure waits
+# LOGIN_RETRY_FIRST seconds, doubling with each failure up to LOGIN_RETRY_MAX.
+BACKOFF_FILE = os.path.join(SCRIPT_DIR, "login-backoff.json")
+TERMINAL_BACKOFF = [  # (lower-case message fragment, what it means, seconds)
+    ("invalid user name/password", "wrong password", 6 * 3600),
+    ("invalid username", "wrong password", 6 * 3600),
+    ("incorrect password", "wrong password", 6 * 3600),
+    ("maximum login limit", "max login limit reached", 15 * 60),
+    ("max login limit", "max login limit reached", 15 * 60),
+    ("data transfer has been exceeded", "data quota exceeded", 6 * 3600),
+    ("quota", "data quota exceeded", 6 * 3600),
+    ("expired", "account disabled or expired", 24 * 3600),
+    ("disabled", "account disabled or expired", 24 * 3600),
+]
+LOGIN_RETRY_FIRST = 60
+LOGIN_RETRY_MAX = 3600
+
+_cached_password = None  # (password, monotonic time it was read)
+_active_portal = None  # a portal found from a captive redirect, used instead of PORTAL_BASE
+
 
 def keychain_get_password():
     try:
@@ -45,22 +145,297 @@ def keychain_set_password(password):
     return r.returncode == 0
 
 
+def _probe_request(url):
+    parts = urllib.parse.urlsplit(url)
+    addresses = PINNED_ADDRESSES.get(parts.hostname)
+    if not addresses:
+        return url
+    netloc = addresses[0] + (f":{parts.port}" if parts.port else "")
+    return urllib.request.Request(parts._replace(netloc=netloc).geturl(), headers={"Host": parts.netloc})
+
+
 def internet_is_working():
+    # One probe, preferring a host that needs no DNS
+    probe = min(CONNECTIVITY_PROBES, key=lambda p: urllib.parse.urlsplit(p[0]).hostname not in PINNED_ADDRESSES)
+    return connectivity_probe(*probe)[0] is True
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A captive redirect is the answer itself, not something to follow
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_probe_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def connectivity_probe(url, expect_status, expect_text):
+    # Returns (result, portal): result is True = online, False = answered but
+    # intercepted (captive), None = no answer. When intercepted, portal is the
+    # origin the captive redirect points at, if any.
+    try:
+        resp = _probe_opener.open(_probe_request(url), timeout=PROBE_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        resp = e  # a redirect or an error page: still an answer
+    except Exception:
+        return None, None
     try:
-        resp = urllib.request.urlopen("http://captive.apple.com/hotspot-detect.html", timeout=5)
-        return "Success" in resp.read().decode("utf-8", errors="ignore")
+        body = resp.read().decode("utf-8", errors="ignore")
+    except Exception:
+        return None, None
+    if resp.status == expect_status and expect_text in body:
+        return True, None
+    return False, portal_from_response(url, resp.status, resp.headers, body)
+
+
+def portal_from_response(probe_url, status, headers, text):
+    # Captive portals answer probes with a redirect (Location header) or a
+    # page with a meta refresh; either one names the portal
+    target = None
+    if 300 <= status < 400:
+        target = headers.get("Location")
+    else:
+        match = META_REFRESH.search(text)
+        if match:
+            import html
+            target = html.unescape(match.group(1))
+    if not target:
+        return None
+    parts = urllib.parse.urlsplit(urllib.parse.urljoin(probe_url, target))
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return None
+    if parts.netloc == urllib.parse.urlsplit(probe_url).netloc:
+        return None
+    if parts.port != SOPHOS_PORT and not parts.path.endswith(SOPHOS_PAGE):
+        return None  # some other captive portal (hotel, cafe)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def portal_base():
+    return _active_portal or PORTAL_BASE
+
+
+def set_active_portal(base):
+    global _active_portal
+    _active_portal = base
+
+
+def trusted_portal(base, source):
+    # A portal found from a redirect gets the credentials only on the NUJS
+    # network and only if it answers a request without credentials like
+    # Sophos does
+    entry = load_networks().get(_subnet(source)) if source else None
+    if get_wifi_ssid() != TARGET_SSID and not (entry or {}).get("campus"):
+        return False
+    query = urllib.parse.urlencode({"mode": "192", "username": "", "producttype": "0"})
+    try:
+        body = urllib.request.urlopen(f"{base}/live?{query}", timeout=3).read()
     except Exception:
         return False
+    return b"<requestresponse>" in body
+
+
+def cached_portal(source):
+    entry = load_networks().get(_subnet(source)) if source else None
+    if entry and entry.get("portal") and entry.get("portal_until", 0) > time.time():
+        return entry["portal"]
+    return None
 
 
 def portal_is_reachable():
     try:
-        urllib.request.urlopen(PORTAL_BASE, timeout=3)
+        urllib.request.urlopen(portal_base(), timeout=3)
         return True
     except Exception:
         return False
 
 
+def portal_accepts_tcp(timeout):
+    url = urllib.parse.urlsplit(portal_base())
+    try:
+        with socket.create_connection((url.hostname, url.port or 80), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_portal(deadline=PORTAL_WAIT_DEADLINE):
+    # Returns (seconds until the portal accepted a connection or None, attempts)
+    start = time.monotonic()
+    end = start + deadline
+    delay = PORTAL_WAIT_FIRST
+    attempts = 0
+    while time.monotonic() < end:
+        attempts += 1
+        if portal_accepts_tcp(min(1.0, max(end - time.monotonic(), 0.01))):
+            return time.monotonic() - start, attempts
+        pause = delay / 2 + random.uniform(0, delay / 2)
+        time.sleep(max(0, min(pause, end - time.monotonic())))
+        delay = min(delay * 2, PORTAL_WAIT_MAX)
+    return None, attempts
+
+
+def _in_network(address, cidr):
+    net, bits = cidr.split("/")
+    mask = (0xFFFFFFFF << (32 - int(bits))) & 0xFFFFFFFF
+    as_int = lambda a: struct.unpack("!I", socket.inet_aton(a))[0]
+    return as_int(address) & mask == as_int(net) & mask
+
+
+def _subnet(address):
+    return address.rsplit(".", 1)[0] + ".0/24"
+
+
+def load_networks():
+    try:
+        with open(NETWORKS_FILE) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def record_visit(source, portal_seen, portal=None):
+    # A network that showed the portal is marked as campus (with the portal
+    # its redirect pointed at, if given); one that didn't counts another
+    # miss, unless it's a campus network (a portal slow to come up there
+    # mustn't stop the next login)
+    if source is None:
+        return
+    if not portal_seen and get_wifi_ssid() == TARGET_SSID:
+        return
+    db = load_networks()
+    key = _subnet(source)
+    entry = db.get(key, {})
+    if portal_seen:
+        if entry.get("campus") and not portal:
+            return
+        entry = {k: v for k, v in entry.items() if k.startswith("portal")}
+        entry["campus"] = True
+        if portal:
+            entry.update(portal=portal, portal_until=round(time.time() + PORTAL_CACHE_TTL))
+    elif entry.get("campus"):
+        return
+    else:
+        entry["misses"] = entry.get("misses", 0) + 1
+        entry["checked"] = round(time.time())
+    db[key] = entry
+    tmp = NETWORKS_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(db, f)
+        os.replace(tmp, NETWORKS_FILE)
+    except OSError:
+        pass
+
+
+def get_wifi_ssid():
+    # Name of the Wi-Fi network, or None if unknown: not on Wi-Fi, or macOS
+    # hiding it (14.4 and later show "<redacted>" to processes without
+    # Location Services access)
+    try:
+        r = subprocess.run(["ipconfig", "getsummary", WIFI_INTERFACE], capture_output=True, text=True, timeout=2)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    for line in r.stdout.splitlines():
+        key, _, value = line.partition(" : ")
+        if key.strip() == "SSID":
+            value = value.strip()
+            return value if value and value != "<redacted>" else None
+    return None
+
+
+def campus_precheck():
+    # Is the portal on this network at all? Decided locally, without a packet
+    # sent: no route towards the portal, another Wi-Fi network (when macOS
+    # tells us its name), or a network where the portal has been missing on
+    # the last visits, is a no. Anything else is plausible and gets probed.
+    # Returns (plausible, reason).
+    source = network_signature()
+    if source is None:
+        return False, "no route to the portal"
+    for cidr in CAMPUS_NETWORKS:
+        if _in_network(source, cidr):
+            return True, f"address {source} is on campus range {cidr}"
+    ssid = get_wifi_ssid()
+    if ssid == TARGET_SSID:
+        return True, f"on {TARGET_SSID}"
+    if ssid:
+        return False, f"on Wi-Fi '{ssid}', not {TARGET_SSID}"
+    entry = load_networks().get(_subnet(source))
+    if (entry and entry.get("misses", 0) >= NETWORK_NEGATIVE_MISSES
+            and 0 <= time.time() - entry["checked"] < NETWORK_NEGATIVE_TTL):
+        return False, f"no portal on {_subnet(source)} the last {entry['misses']} visits"
+    return True, f"address {source}, portal not ruled out"
+
+
+def _run_probe(results, name, fn, args):
+    try:
+        results.put((name, fn(*args)))
+    except Exception:
+        results.put((name, None))
+
+
+def probe_network(timeout=PROBE_TIMEOUT):
+    # Race the portal probe against every connectivity probe and decide from the
+    # first conclusive answers. Returns (verdict, portal_up, seconds); verdict is
+    # "online", "captive" or "offline". Probes still in flight are abandoned.
+    start = time.monotonic()
+    results = queue.Queue()
+    jobs = [("portal", portal_is_reachable, ())]
+    jobs += [("internet", connectivity_probe, p) for p in CONNECTIVITY_PROBES]
+    for name, fn, args in jobs:
+        threading.Thread(target=_run_probe, args=(results, name, fn, args), daemon=True).start()
+
+    deadline = start + timeout
+    pending = len(CONNECTIVITY_PROBES)
+    portal_up = None
+    intercepted = False
+    discovered = None
+    probed_base = portal_base()
+    verdict = None
+    for _ in jobs:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            name, result = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if name == "portal":
+            portal_up = result
+        else:
+            pending -= 1
+            ok, found = result or (None, None)
+            if ok:
+                verdict = "online"
+                break
+            if ok is False:
+                intercepted = True
+                discovered = discovered or found
+        if intercepted and discovered and discovered != probed_base:
+            # Redirected somewhere else: the configured portal's answer is moot
+            verdict = "captive"
+            portal_up = False
+            break
+        if portal_up and (intercepted or pending == 0):
+            verdict = "captive"
+            break
+        if portal_up is False and pending == 0:
+            break
+
+    if discovered and discovered != probed_base:
+        source = network_signature()
+        if trusted_portal(discovered, source):
+            print(f"[*] Captive redirect points at portal {discovered} (was {probed_base})")
+            set_active_portal(discovered)
+            record_visit(source, True, portal=discovered)
+        else:
+            print(f"[*] Captive redirect to {discovered} ignored: not a NUJS portal on this network")
+    if verdict is None:
+        verdict = "captive" if portal_up else "offline"
+    return verdict, bool(portal_up), time.monotonic() - start
+
+
 def sophos_login(password):
     params = urllib.parse.urlencode({
         "mode": "191",
@@ -72,7 +447,7 @@ def sophos_login(password):
 
     try:
         req = urllib.request.Request(
-            f"{PORTAL_BASE}/login.xml",
+            f"{portal_base()}/login.xml",
             data=params,
             method="POST",
             headers={"Content-Type": "application/x-www-form-urlencoded"},
@@ -85,45 +460,276 @@ def sophos_login(password):
         message = root.findtext("message", "").strip()
 
         print(f"[*] Portal response — status: {status}, message: {message}")
-        return status == "LIVE"
+        return status == "LIVE", message
 
     except Exception as e:
         print(f"[!] Login request failed: {e}")
-        return False
+        return False, ""
 
 
-def main():
-    if internet_is_working():
-        print("[*] Internet already working. No login needed.")
-        return
+def sophos_keepalive():
+    # Sophos "live" request (mode 192). True if the portal acked our session,
+    # False once it's gone (e.g. "login_again"), None if the request failed.
+    query = urllib.parse.urlencode({
+        "mode": "192",
+        "username": USERNAME,
+        "a": str(int(time.time() * 1000)),
+        "producttype": "0",
+    })
+    try:
+        resp = urllib.request.urlopen(f"{portal_base()}/live?{query}", timeout=10)
+        body = resp.read().decode("utf-8", errors="ignore")
+        return ElementTree.fromstring(body).findtext("ack", "").strip() == "ack"
+    except Exception as e:
+        print(f"[!] Keepalive request failed: {e}")
+        return None
 
-    # Wait for portal to become reachable (network may still be initializing after wake/connect)
-    portal_ready = False
-    for attempt in range(1, 11):
-        if portal_is_reachable():
-            portal_ready = True
+
+def keepalive_delay():
+    # Half the session timeout, +/- KEEPALIVE_JITTER so machines that logged
+    # in together don't all hit the portal at the same moment
+    return SESSION_TIMEOUT / 2 * random.uniform(1 - KEEPALIVE_JITTER, 1 + KEEPALIVE_JITTER)
+
+
+def get_password(interactive):
+    global _cached_password
+    if _cached_password and time.monotonic() - _cached_password[1] < PASSWORD_CACHE_TTL:
+        return _cached_password[0]
+    password = keychain_get_password()
+    if not password and interactive:
+        password = input("Enter your NUJS WiFi password (saved to Keychain): ").strip()
+        if password:
+            keychain_set_password(password)
+    _cached_password = (password, time.monotonic()) if password else None
+    return password
+
+
+def forget_password():
+    # Next login reads the Keychain again (e.g. after the password was changed there)
+    global _cached_password
+    _cached_password = None
+
+
+def _credential_id(password):
+    return hashlib.sha256(f"{USERNAME}\0{password}".encode("utf-8")).hexdigest()[:16]
+
+
+def load_backoff(password):
+    # The saved back-off for this password, expired or not ({} if none)
+    try:
+        with open(BACKOFF_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return saved if saved.get("credentials") == _credential_id(password) else {}
+
+
+def save_backoff(password, message):
+    # Returns (what failed, seconds until the next attempt)
+    text = message.lower()
+    for fragment, state, seconds in TERMINAL_BACKOFF:
+        if fragment in text:
+            failures = 0
             break
-        print(f"[*] Waiting for portal... attempt {attempt}/10")
-        time.sleep(3)
+    else:
+        state = "portal error"
+        failures = load_backoff(password).get("failures", 0) + 1
+        seconds = min(LOGIN_RETRY_FIRST * 2 ** (failures - 1), LOGIN_RETRY_MAX)
+    saved = {"state": state, "credentials": _credential_id(password), "failures": failures,
+             "until": time.time() + seconds}
+    tmp = BACKOFF_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp, BACKOFF_FILE)
+    except OSError:
+        pass
+    return state, seconds
 
-    if not portal_ready:
-        print("[*] Portal not reachable after 30s — not on NUJS network.")
+
+def clear_backoff():
+    try:
+        os.remove(BACKOFF_FILE)
+    except OSError:
+        pass
+
+
+def run_once(interactive=True, force=False):
+    # "login" if we logged in, "online" if the internet already worked
+    started = time.perf_counter()
+    on_campus, why = campus_precheck()
+    print(f"[*] Network check: {why} ({(time.perf_counter() - started) * 1e6:.0f} us)")
+    if not on_campus and not force:
+        print("[*] Not on NUJS network. Nothing to do.")
         return
 
+    source = network_signature()
+    # The portal this network redirected us to last time, if any
+    set_active_portal(cached_portal(source))
+    verdict, portal_ready, elapsed = probe_network()
+    print(f"[*] Probe verdict: {verdict} in {elapsed * 1000:.0f} ms")
+    if verdict == "online":
+        print("[*] Internet already working. No login needed.")
+        record_visit(source, portal_ready)
+        return "online"
+
+    # Wait for portal to become reachable (network may still be initializing after wake/connect)
+    if not portal_ready:
+        print(f"[*] Waiting for portal (up to {PORTAL_WAIT_DEADLINE}s)...")
+        waited, attempts = wait_for_portal()
+        if waited is None:
+            print(f"[*] Portal not reachable after {PORTAL_WAIT_DEADLINE}s ({attempts} probes) — not on NUJS network.")
+            record_visit(source, False)
+            return
+        print(f"[*] Portal came up after {waited:.2f}s ({attempts} probes)")
+    record_visit(source, True)
+
     print("[*] Internet down, portal reachable — logging in...")
 
-    password = keychain_get_password()
+    password = get_password(interactive)
     if not password:
-        password = input("Enter your NUJS WiFi password (saved to Keychain): ").strip()
-        if not password:
-            print("[!] No password. Exiting.")
+        print("[!] No password. Exiting.")
+        if interactive:
             sys.exit(1)
-        keychain_set_password(password)
+        return
+
+    backoff = load_backoff(password)
+    if time.time() < backoff.get("until", 0):
+        until = time.strftime("%Y-%m-%d %H:%M", time.localtime(backoff["until"]))
+        print(f"[*] Last login failed ({backoff['state']}). Not retrying until {until}.")
+        return
 
-    if sophos_login(password):
+    live, message = sophos_login(password)
+    if live:
+        clear_backoff()
         print("[+] Logged in successfully!")
+        return "login"
+    state, seconds = save_backoff(password, message)
+    if any(m in message.lower() for m in WRONG_PASSWORD_MESSAGES):
+        forget_password()
+        print("[!] Portal rejected the password. Update it with: bash setup.sh")
+    print(f"[!] Login failed: {state}. Not retrying for {seconds // 60:.0f} min.")
+
+
+def _lock_run(f, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+
+def run_coalesced(interactive=True, force=False):
+    # flock() is dropped by the OS when the holder exits, even if it crashed
+    arrived = time.time()
+    with open(RUN_LOCK_FILE, "a") as lock:
+        if not _lock_run(lock, 0):
+            print("[*] Another login run is in progress - waiting for its result...")
+            if not _lock_run(lock, RUN_LOCK_WAIT):
+                print(f"[*] Other run still busy after {RUN_LOCK_WAIT}s. Giving up.")
+                return
+            try:
+                with open(LAST_RUN_FILE) as f:
+                    last = json.load(f)
+            except (OSError, ValueError):
+                last = {}
+            if last.get("finished_at", 0) >= arrived and last.get("source") == network_signature():
+                print("[*] Other run finished on this network. Not repeating it.")
+                return last.get("outcome")
+            # It was for another network; this one still needs a run
+        outcome = None
+        try:
+            outcome = run_once(interactive, force)
+            return outcome
+        finally:
+            tmp = LAST_RUN_FILE + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump({"source": network_signature(), "finished_at": time.time(), "outcome": outcome}, f)
+                os.replace(tmp, LAST_RUN_FILE)
+            except OSError:
+                pass
+
+
+def network_signature():
+    # Local address the OS would use to reach the portal. Changes on connect,
+    # disconnect and roaming; a UDP connect() sends no packets.
+    host = urllib.parse.urlsplit(PORTAL_BASE).hostname
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((host, 9))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+def run_daemon():
+    # launchd sends stdout to the log file; flush every line
+    sys.stdout.reconfigure(line_buffering=True)
+    print(f"[*] Daemon started (pid {os.getpid()}).")
+    last_sig = None
+    last_wall = time.time()
+    last_check = 0.0
+    keepalive_at = None
+    while True:
+        sig = network_signature()
+        wall = time.time()
+        now = time.monotonic()
+
+        reason = None
+        if sig != last_sig:
+            reason = f"network change ({sig or 'no route'})"
+            keepalive_at = None
+        elif wall - last_wall > DAEMON_POLL * 5:
+            reason = "wake from sleep"
+        elif keepalive_at is not None and now >= keepalive_at:
+            live = sophos_keepalive()
+            if live is False:
+                reason = "keepalive rejected"
+                keepalive_at = None
+            else:
+                keepalive_at = now + (keepalive_delay() if live else KEEPALIVE_RETRY)
+        elif now - last_check >= DAEMON_RECHECK:
+            reason = "periodic check"
+        last_sig, last_wall = sig, wall
+
+        if reason and sig:
+            # Periodic checks stay silent while the internet works, and off
+            # campus they don't even probe
+            if reason != "periodic check" or (campus_precheck()[0] and probe_network()[0] != "online"):
+                print(f"[*] {time.strftime('%Y-%m-%d %H:%M:%S')} Trigger: {reason}")
+                try:
+                    outcome = run_coalesced(interactive=False)
+                except Exception as e:
+                    print(f"[!] Login run failed: {e}")
+                    outcome = None
+                # Keep our own session alive; a session that was already
+                # working keeps whatever schedule it had
+                if outcome == "login":
+                    keepalive_at = time.monotonic() + keepalive_delay()
+                elif outcome is None:
+                    keepalive_at = None
+            last_check = time.monotonic()
+
+        time.sleep(DAEMON_POLL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NUJS-CAMPUS WiFi auto-login")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and log in whenever the network changes")
+    parser.add_argument("--force", action="store_true",
+                        help="try the portal even if this address isn't on a campus range")
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon()
     else:
-        print("[!] Login may have failed. Try running again or check credentials.")
+        run_coalesced(force=args.force)
 
 
 if __name__ == "__main__":
@@ -44,6 +44,8 @@ echo "[+] Script installed to $INSTALL_DIR/nujs-wifi-login.py"
 security delete-generic-password -s "$KEYCHAIN_SERVICE" -a "$USERNAME" 2>/dev/null || true
 security add-generic-password -s "$KEYCHAIN_SERVICE" -a "$USERNAME" -w "$PASSWORD"
 echo "[+] Password saved to macOS Keychain."
+# New credentials get a fresh start, not the old ones' login back-off
+rm -f "$INSTALL_DIR/login-backoff.json"
 
 # 4. Install LaunchAgent
 mkdir -p "$LAUNCH_AGENTS_DIR"
@@ -62,11 +64,10 @@ cat > "$LAUNCH_AGENTS_DIR/$PLIST_NAME.plist" <<EOF
     <array>
         <string>/usr/bin/python3</string>
         <string>$INSTALL_DIR/nujs-wifi-login.py</string>
+        <string>--daemon</string>
     </array>
-    <key>WatchPaths</key>
-    <array>
-        <string>/Library/Preferences/SystemConfiguration</string>
-    </array>
+    <key>KeepAlive</key>
+    <true/>
     <key>StandardOutPath</key>
     <string>$INSTALL_DIR/nujs-wifi-login.log</string>
     <key>StandardErrorPath</key>
@@ -82,7 +83,7 @@ echo "[+] LaunchAgent installed and loaded."
 
 echo
 echo "=== Setup complete! ==="
-echo "The script will auto-run on:"
+echo "The login daemon now runs in the background and logs in on:"
 echo "  - Login / restart"
 echo "  - Wake from sleep"
 echo "  - WiFi network change"
@@ -10,7 +10,10 @@ echo "=== Uninstalling NUJS WiFi Auto-Login ==="
 
 launchctl unload "$LAUNCH_AGENTS_DIR/$PLIST_NAME.plist" 2>/dev/null && echo "[+] LaunchAgent unloaded."
 rm -f "$LAUNCH_AGENTS_DIR/$PLIST_NAME.plist" && echo "[+] Plist removed."
-rm -f "$INSTALL_DIR/nujs-wifi-login.py" "$INSTALL_DIR/nujs-wifi-login.log" && echo "[+] Script and logs removed."
+rm -f "$INSTALL_DIR/nujs-wifi-login.py" "$INSTALL_DIR/nujs-wifi-login.log" "$INSTALL_DIR/networks.json" \
+    "$INSTALL_DIR/nujs-wifi-login.lock" "$INSTALL_DIR/last-run.json" \
+    "$INSTALL_DIR/login-backoff.json" \
+    && echo "[+] Script and logs removed."
 security delete-generic-password -s "$KEYCHAIN_SERVICE" 2>/dev/null && echo "[+] Keychain entry removed."
 
 echo "=== Done ==="
@@ -0,0 +1,194 @@
+"""
+Time-to-internet benchmark for the NUJS WiFi login script.
+Drives nujs-wifi-login.py's run_once() flow against fake-portal.py on
+localhost and reports p50/p95/p99 time-to-LIVE per scenario. Each iteration
+is a fresh "wake": new portal, empty connection pool, no session. Multi-link
+scenarios add other interfaces towards the portal as extra loopback source
+addresses (127.0.0.2, ...) and time until every one of them is logged in.
+The keepalive scenario keeps the session alive past the portal's session TTL,
+expires it, and times the full login that must follow.
+With --batch N it instead logs in N simulated accounts through batch mode
+(1 in 20 with a wrong password) and reports throughput and per-state counts.
+
+Usage:  python bench-login.py [--iterations 20] [--scenario cold-wake ...]
+        python bench-login.py --batch 500 [--parallel 16] [--rate 50] [--scenario slow-portal]
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name -> FakePortal options
+SCENARIOS = {
+    "warm": {"latency": 0.005},
+    "slow-portal": {"latency": 0.25, "latency_jitter": 0.1},
+    "cold-wake": {"ready_delay": 1.5},
+    "cold-wake-slow": {"ready_delay": 3.0, "latency": 0.1},
+    "flaky": {"drop_rate": 0.2},
+    "login-errors": {"error_rate": 0.3, "error_message": "Service temporarily unavailable"},
+    # A quarter of login POSTs never answered; with networks.json kept between
+    # runs the hedge delay comes from the learned reply times instead of the default
+    "stalls": {"stall_rate": 0.25},
+    "stalls-learned": {"stall_rate": 0.25, "keep_networks": True},
+    # Wired + Wi-Fi (+ a USB dongle) behind the same portal
+    "two-links": {"links": 2},
+    "three-links-slow": {"links": 3, "latency": 0.1},
+    # Sessions the portal drops after 0.6 s idle, kept alive for three TTLs
+    "keepalive": {"session_ttl": 0.6, "keepalive": True},
+}
+
+
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_iteration(login, fake, options, username):
+    options = dict(options)
+    keep_networks = options.pop("keep_networks", False)
+    keepalive = options.pop("keepalive", False)
+    # The default route's address, then one per other interface
+    sources = ["127.0.0.1"] + [f"127.0.0.{i + 2}" for i in range(options.pop("links", 1) - 1)]
+    login._network = login.FakeNetwork(ssid=login.TARGET_SSID, portal_links=[
+        {"name": f"link{i}", "address": address} for i, address in enumerate(sources)])
+    portal = fake.FakePortal(**options).start()
+    login.PORTAL_BASE = portal.base
+    login.CAPTIVE_PROBE_URL = f"{portal.base}/hotspot-detect.html"
+    login.CONNECTIVITY_PROBES = [(login.CAPTIVE_PROBE_URL, 200, "Success")]
+    login.HTTP.close()
+    login.link_sessions.clear()
+    if not keep_networks:
+        try:
+            os.remove(login.NETWORKS_FILE)  # every iteration is a first visit
+        except OSError:
+            pass
+    cfg = {"username": username, "credential_store": "file"}
+    if portal.session_ttl is not None:
+        cfg["session_timeout"] = portal.session_ttl
+    try:
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            login.run_once(cfg, use_cache=False)
+            if keepalive and None not in [portal.login_time(username, address) for address in sources]:
+                start = keep_alive_then_expire(login, portal, cfg)
+        logged_in = [portal.login_time(username, address) for address in sources]
+        if start is None or None in logged_in:
+            return None, dict(portal.counts)
+        return max(logged_in) - start, dict(portal.counts)
+    finally:
+        portal.stop()
+
+
+def keep_alive_then_expire(login, portal, cfg):
+    # Keepalives alone must hold the session for three TTLs. Then the portal
+    # drops it: the next keepalive has to be rejected and a full login follow.
+    # Returns when that login started, or None if any step went wrong.
+    logins = portal.counts["login"]
+    until = time.monotonic() + 3 * portal.session_ttl
+    while time.monotonic() < until:
+        time.sleep(login.keepalive_delay(cfg))
+        if login.send_keepalive(cfg) is None:
+            return None
+    if not portal.live_session(cfg["username"]) or portal.counts["login"] != logins:
+        return None
+    portal.expire_all()
+    if login.send_keepalive(cfg) is not None:
+        return None
+    start = time.monotonic()
+    login.run_once(cfg, use_cache=False)
+    return start if portal.counts["login"] > logins else None
+
+
+def run_batch(login, fake, options, n, parallel, rate):
+    accounts = [{"username": f"lab{i:04d}", "password": f"pw{i}", "source": None} for i in range(n)]
+    known = {a["username"]: a["password"] for a in accounts}
+    for a in accounts[::20]:
+        a["password"] = "wrong"
+    portal = fake.FakePortal(accounts=known, **options).start()
+    login.PORTAL_BASE = portal.base
+    try:
+        start = time.monotonic()
+        results = login.batch_login(accounts, parallel=parallel, rate=rate)
+        elapsed = time.monotonic() - start
+    finally:
+        portal.stop()
+    times = [r["ms"] for r in results if r["state"] in login.SUCCESS_STATES]
+    states = {}
+    for r in results:
+        states[r["state"].value] = states.get(r["state"].value, 0) + 1
+    print(f"{n} accounts, {parallel} in flight, rate {rate or 'unlimited'}/s: "
+          f"{elapsed:.2f}s ({n / elapsed:.0f} accounts/s), portal saw {portal.counts['login']} logins")
+    print(f"per-account p50 {percentile(times, 50) or 0:.0f} ms, p95 {percentile(times, 95) or 0:.0f} ms")
+    for state, count in sorted(states.items()):
+        print(f"  {state}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark time-to-LIVE against a local fake portal")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--batch", type=int, metavar="N", help="benchmark batch mode with N accounts")
+    parser.add_argument("--parallel", type=int, default=16, help="batch: logins in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="batch: requests per second, 0 for no limit")
+    args = parser.parse_args()
+
+    login = load_script("nujs-wifi-login.py", "nujs_wifi_login")
+    fake = load_script("fake-portal.py", "fake_portal")
+    tmp = tempfile.mkdtemp(prefix="nujs-wifi-bench-")
+    login.LOG_FILE = os.path.join(tmp, "nujs-wifi-login.log")
+    login.EVENTS_FILE = os.path.join(tmp, "nujs-wifi-events.jsonl")
+    login.BACKOFF_FILE = os.path.join(tmp, "login-backoff.json")
+    login.STATE_FILE = os.path.join(tmp, "state.json")
+    login.STATS_FILE = os.path.join(tmp, "stats.json")
+    login.STATS_JOURNAL = os.path.join(tmp, "stats.jsonl")
+    login.NETWORKS_FILE = os.path.join(tmp, "networks.json")
+    # Passwords come from a credential store, as on an installed machine
+    login.SECRETS_FILE = os.path.join(tmp, "secrets.json")
+    login.SECRETS_KEY_FILE = os.path.join(tmp, "secrets.key")
+    store = login.EncryptedFileStore()
+    for i in range(args.iterations):
+        store.set(f"bench{i}", "secret")
+
+    if args.batch:
+        for name in args.scenario or ["warm"]:
+            print(f"[{name}]")
+            run_batch(login, fake, SCENARIOS[name], args.batch, args.parallel, args.rate)
+        return
+
+    print(f"{'scenario':<16}{'runs':>6}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/run':>9}")
+    for name in args.scenario or list(SCENARIOS):
+        times, failures, requests = [], 0, 0
+        for i in range(args.iterations):
+            elapsed, counts = run_iteration(login, fake, SCENARIOS[name], f"bench{i}")
+            requests += counts["login"] + counts["live"] + counts["probe"]
+            if elapsed is None:
+                failures += 1
+            else:
+                times.append(elapsed * 1000)
+        cols = [percentile(times, p) for p in (50, 95, 99)]
+        cols = "".join(f"{c:>10.0f}" if c is not None else f"{'-':>10}" for c in cols)
+        print(f"{name:<16}{args.iterations:>6}{failures:>6}{cols}{requests / args.iterations:>9.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
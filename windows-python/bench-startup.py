@@ -0,0 +1,201 @@
+"""
+Cold-start benchmark for the NUJS WiFi login script.
+Spawns a fresh Python that runs nujs-wifi-login.py's run_once() flow against
+fake-portal.py and measures the time from spawn to the first request reaching
+the portal, plus the script's own import cost from -X importtime. The
+password comes from the encrypted file store. Exits 1 if the login path
+imported a module it shouldn't, if an off-campus run touched the credential
+store, or if start-up got slower than a saved baseline.
+
+Usage:  python bench-startup.py [--runs 10] [--zipapp]
+        python bench-startup.py --save-baseline
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(SCRIPT_DIR, "nujs-wifi-login.py")
+BASELINE_FILE = os.path.join(SCRIPT_DIR, "startup-baseline.json")
+
+# Heavy modules the plain login path has no business importing: the script
+# speaks HTTP over raw sockets and imports everything else lazily
+FORBIDDEN = ["http.client", "email", "ssl", "xml.etree", "concurrent.futures",
+             "argparse", "subprocess", "csv", "hashlib", "html"]
+# What reading the password from the file store imports: fine once a run
+# logs in, but a run that doesn't (off campus, already online) must not
+STORE_MODULES = ["hashlib", "hmac", "base64"]
+
+# Runs in the spawned interpreter: load the script the way a trigger does
+# (compiled from source, or imported from a zipapp), point it at the fake
+# portal and do one login
+DRIVER = """
+import sys
+script, argv0, base, ssid = sys.argv[1:5]
+sys.argv = [argv0]
+if script.endswith(".pyz"):
+    sys.path.insert(0, script)
+    import nujs_wifi_login
+    ns = vars(nujs_wifi_login)
+else:
+    ns = {"__name__": "nujs_wifi_login", "__file__": script}
+    with open(script, encoding="utf-8") as f:
+        exec(compile(f.read(), script, "exec"), ns)
+ns["PORTAL_BASE"] = base
+ns["CAPTIVE_PROBE_URL"] = base + "/hotspot-detect.html"
+ns["CONNECTIVITY_PROBES"] = [(ns["CAPTIVE_PROBE_URL"], 200, "Success")]
+ns["_network"] = ns["FakeNetwork"](ssid=ssid or ns["TARGET_SSID"])
+ns["run_once"]({"username": "bench", "credential_store": "file"}, use_cache=False)
+"""
+
+
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_importtime(stderr):
+    # {module: microseconds spent in the module itself}; the script's own
+    # module (zipapp) is left out so both ways of loading it compare fairly
+    found = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if own.strip().isdigit() and name.strip() != "nujs_wifi_login":
+            found[name.strip()] = int(own)
+    return found
+
+
+def all_imported(stderr):
+    return {line.rsplit("|", 1)[1].strip() for line in stderr.splitlines()
+            if line.startswith("import time:") and line.count("|") == 2}
+
+
+def interpreter_modules():
+    # What a bare interpreter imports anyway (site, encodings, ...)
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"],
+                       capture_output=True, text=True)
+    return all_imported(r.stderr)
+
+
+def spawn(script, tmp, base, ssid=""):
+    # The script's files (secrets included) live next to argv[0], in tmp
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", DRIVER,
+                           script, os.path.join(tmp, "nujs-wifi-login.py"), base, ssid],
+                          capture_output=True, text=True, timeout=60)
+
+
+def run_one(fake, script, tmp, baseline_modules):
+    portal = fake.FakePortal().start()
+    try:
+        start = time.monotonic()
+        r = spawn(script, tmp, portal.base)
+        first = portal.first_request_at
+    finally:
+        portal.stop()
+    if first is None:
+        raise RuntimeError(f"script never reached the portal:\n{r.stdout}{r.stderr[-2000:]}")
+    imports = {k: v for k, v in parse_importtime(r.stderr).items() if k not in baseline_modules}
+    return (first - start) * 1000, sum(imports.values()) / 1000, imports, all_imported(r.stderr)
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def bench(fake, script, runs, tmp, baseline_modules):
+    firsts, import_ms, slowest, modules = [], [], {}, set()
+    for _ in range(runs):
+        first, total, imports, seen = run_one(fake, script, tmp, baseline_modules)
+        firsts.append(first)
+        import_ms.append(total)
+        modules |= seen
+        for name, us in imports.items():
+            slowest.setdefault(name, []).append(us / 1000)
+    top = sorted(((median(v), k) for k, v in slowest.items()), reverse=True)[:6]
+    return {"first_request_ms": median(firsts), "first_request_min": min(firsts),
+            "first_request_max": max(firsts), "imports_ms": median(import_ms),
+            "slowest": top, "modules": modules}
+
+
+def report(label, result):
+    print(f"{label:<10} first request p50 {result['first_request_ms']:.0f} ms "
+          f"(min {result['first_request_min']:.0f}, max {result['first_request_max']:.0f}), "
+          f"script imports p50 {result['imports_ms']:.1f} ms")
+    print("           slowest imports: " + ", ".join(f"{name} {ms:.1f}" for ms, name in result["slowest"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cold start to first portal request")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--zipapp", action="store_true",
+                        help="also benchmark the precompiled zipapp setup.py can install")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help=f"record this machine's numbers in {os.path.basename(BASELINE_FILE)}")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (default: 0.25 = 25%%)")
+    args = parser.parse_args()
+
+    fake = load_script("fake-portal.py", "fake_portal")
+    tmp = tempfile.mkdtemp(prefix="nujs-wifi-startup-")
+    baseline_modules = interpreter_modules()
+    login = load_script("nujs-wifi-login.py", "nujs_wifi_login")
+    login.SECRETS_FILE = os.path.join(tmp, "secrets.json")
+    login.SECRETS_KEY_FILE = os.path.join(tmp, "secrets.key")
+    login.EncryptedFileStore().set("bench", "secret")
+
+    results = {"script": bench(fake, SCRIPT, args.runs, tmp, baseline_modules)}
+    if args.zipapp:
+        setup = load_script("setup.py", "nujs_setup")
+        pyz = os.path.join(tmp, "nujs-wifi-login.pyz")
+        setup.build_zipapp(SCRIPT, pyz)
+        results["zipapp"] = bench(fake, pyz, args.runs, tmp, baseline_modules)
+    for label, result in results.items():
+        report(label, result)
+
+    def forbidden(modules, names):
+        return sorted(m for m in modules if any(m == f or m.startswith(f + ".") for f in names))
+
+    failed = False
+    for label, result in results.items():
+        bad = forbidden(result["modules"], [f for f in FORBIDDEN if f not in STORE_MODULES])
+        if bad:
+            print(f"[!] FAIL ({label}): login path imported {', '.join(bad)}")
+            failed = True
+    bad = forbidden(all_imported(spawn(SCRIPT, tmp, "http://127.0.0.1:9", "Home WiFi").stderr),
+                    FORBIDDEN + STORE_MODULES)
+    if bad:
+        print(f"[!] FAIL (off campus): run imported {', '.join(bad)}")
+        failed = True
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({label: {"first_request_ms": r["first_request_ms"], "imports_ms": r["imports_ms"]}
+                       for label, r in results.items()}, f, indent=2)
+        print(f"[*] Baseline saved to {BASELINE_FILE}")
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+        for label, result in results.items():
+            for key in ("first_request_ms", "imports_ms"):
+                before = baseline.get(label, {}).get(key)
+                # A couple of ms of slack so timer noise on fast machines doesn't fail the run
+                if before is not None and result[key] > before * (1 + args.tolerance) + 2:
+                    print(f"[!] FAIL ({label}): {key} {result[key]:.1f} vs baseline {before:.1f}")
+                    failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
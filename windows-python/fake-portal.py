@@ -0,0 +1,235 @@
+"""
+Local stand-in for the NUJS Sophos/Cyberoam captive portal.
+Serves login.xml (mode 191), live (mode 192) and a captive probe page
+(/hotspot-detect.html) so the login script can be exercised and benchmarked
+off campus. Latency, readiness delay, error replies, dropped connections,
+stalled logins and session expiry are all configurable. Like the real portal
+it keeps a session per username and client address.
+
+Run standalone:  python fake-portal.py --port 8090 --latency 0.05
+"""
+
+import argparse
+import http.server
+import random
+import threading
+import time
+import urllib.parse
+
+LIVE_XML = ("<?xml version='1.0' ?><requestresponse><status><![CDATA[LIVE]]></status>"
+            "<message><![CDATA[You are signed in as {username}]]></message></requestresponse>")
+LOGIN_XML = ("<?xml version='1.0' ?><requestresponse><status><![CDATA[LOGIN]]></status>"
+             "<message><![CDATA[{message}]]></message></requestresponse>")
+ACK_XML = "<?xml version='1.0' ?><requestresponse><ack><![CDATA[{ack}]]></ack></requestresponse>"
+WRONG_PASSWORD = "Login failed. Invalid user name/password. Please contact the administrator."
+PORTAL_PAGE = "<html><head><title>Sophos</title></head><body>NUJS captive portal</body></html>"
+
+
+class FakePortal:
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, latency_jitter=0.0,
+                 ready_delay=0.0, error_rate=0.0, error_message=WRONG_PASSWORD,
+                 drop_rate=0.0, session_ttl=None, accounts=None, stall_rate=0.0, stall_seconds=30):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.ready_delay = ready_delay
+        self.error_rate = error_rate
+        self.error_message = error_message
+        self.drop_rate = drop_rate
+        self.stall_rate = stall_rate      # fraction of login POSTs left hanging
+        self.stall_seconds = stall_seconds
+        self.session_ttl = session_ttl
+        self.accounts = accounts          # {username: password}, None accepts anyone
+        self.sessions = {}                # (username, client ip) -> [expires or None, logged in at]
+        self.counts = {"login": 0, "live": 0, "probe": 0, "dropped": 0, "stalled": 0, "errors": 0}
+        self.lock = threading.Lock()
+
+        handler = type("Handler", (_Handler,), {"portal": self})
+        # Bind now so the port is known, but only listen once "ready": until
+        # then connections are refused, like the real portal right after wake.
+        self.server = http.server.ThreadingHTTPServer((host, port), handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.host, self.port = self.server.server_address[:2]
+        self.base = f"http://{self.host}:{self.port}"
+        self.ready_at = None
+        self.first_request_at = None      # time.monotonic() of the first request served
+        self._stopped = threading.Event()
+
+    def start(self):
+        # Without a ready delay the portal is listening by the time this
+        # returns, so callers never race the serving thread
+        if not self.ready_delay:
+            self._activate()
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _activate(self):
+        self.server.server_activate()
+        self.ready_at = time.monotonic()
+
+    def _serve(self):
+        if self.ready_at is None:
+            if self._stopped.wait(self.ready_delay):
+                return
+            self._activate()
+        self.server.serve_forever(poll_interval=0.05)
+
+    def stop(self):
+        self._stopped.set()
+        if self.ready_at is not None:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def live_session(self, username=None, ip=None):
+        now = time.monotonic()
+        with self.lock:
+            for (name, client), (expires, _) in list(self.sessions.items()):
+                if expires is not None and expires <= now:
+                    del self.sessions[name, client]
+                    continue
+                if (username is None or name == username) and (ip is None or client == ip):
+                    return name
+        return None
+
+    def login_time(self, username, ip=None):
+        # When username's first session (or its session from ip) began
+        with self.lock:
+            times = [at for (name, client), (_, at) in self.sessions.items()
+                     if name == username and (ip is None or client == ip)]
+            return min(times) if times else None
+
+    def clients(self, username):
+        with self.lock:
+            return sorted(client for name, client in self.sessions if name == username)
+
+    def expire_all(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def _expiry(self):
+        return None if self.session_ttl is None else time.monotonic() + self.session_ttl
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out separately
+    portal = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _delay_or_drop(self):
+        p = self.portal
+        if p.first_request_at is None:
+            p.first_request_at = time.monotonic()
+        if p.latency or p.latency_jitter:
+            time.sleep(p.latency + random.uniform(0, p.latency_jitter))
+        if p.drop_rate and random.random() < p.drop_rate:
+            with p.lock:
+                p.counts["dropped"] += 1
+            self.close_connection = True
+            return True
+        return False
+
+    def _send(self, status, body, content_type="text/xml", headers=None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        p = self.portal
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if self._delay_or_drop():
+            return
+        ip = self.client_address[0]
+
+        if url.path == "/hotspot-detect.html":
+            with p.lock:
+                p.counts["probe"] += 1
+            if p.live_session(ip=ip):
+                self._send(200, "<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>",
+                           content_type="text/html")
+            else:
+                self._send(302, "", content_type="text/html",
+                           headers={"Location": f"{p.base}/httpclient.html"})
+        elif url.path == "/live":
+            username = query.get("username", "")
+            with p.lock:
+                p.counts["live"] += 1
+            if p.live_session(username=username, ip=ip):
+                with p.lock:
+                    p.sessions[username, ip][0] = p._expiry()
+                self._send(200, ACK_XML.format(ack="ack"))
+            else:
+                self._send(200, ACK_XML.format(ack="login_again"))
+        else:
+            self._send(200, PORTAL_PAGE, content_type="text/html")
+
+    def do_POST(self):
+        p = self.portal
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8", "ignore")))
+        if p.stall_rate and random.random() < p.stall_rate:
+            # Accepted but never answered, like a portal busy right after association
+            with p.lock:
+                p.counts["stalled"] += 1
+            p._stopped.wait(p.stall_seconds)
+            self.close_connection = True
+            return
+        if self._delay_or_drop():
+            return
+        if urllib.parse.urlsplit(self.path).path != "/login.xml" or form.get("mode") != "191":
+            self._send(404, "")
+            return
+
+        username = form.get("username", "")
+        with p.lock:
+            p.counts["login"] += 1
+            rejected = p.accounts is not None and p.accounts.get(username) != form.get("password")
+            failed = rejected or (p.error_rate and random.random() < p.error_rate)
+            if failed:
+                p.counts["errors"] += 1
+            else:
+                p.sessions[username, self.client_address[0]] = [p._expiry(), time.monotonic()]
+        if failed:
+            self._send(200, LOGIN_XML.format(message=WRONG_PASSWORD if rejected else p.error_message))
+        else:
+            self._send(200, LIVE_XML.format(username=username))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Sophos captive portal for local testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument("--ready-delay", type=float, default=0.0, help="seconds before the portal accepts connections")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of logins answered with error XML")
+    parser.add_argument("--error-message", default=WRONG_PASSWORD)
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of requests dropped without a reply")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of logins that get no reply")
+    parser.add_argument("--stall-seconds", type=float, default=30, help="how long a stalled login hangs")
+    parser.add_argument("--session-ttl", type=float, default=None, help="seconds a session lives without keepalive")
+    args = parser.parse_args()
+
+    portal = FakePortal(args.host, args.port, args.latency, args.latency_jitter, args.ready_delay,
+                        args.error_rate, args.error_message, args.drop_rate, args.session_ttl,
+                        stall_rate=args.stall_rate, stall_seconds=args.stall_seconds).start()
+    print(f"[*] Fake portal on {portal.base} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        portal.stop()
+
+
+if __name__ == "__main__":
+    main()
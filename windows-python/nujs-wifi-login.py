@@ -1,36 +1,773 @@
 """
 Auto-login script for NUJS-CAMPUS WiFi (Sophos/Cyberoam captive portal).
-Windows version — uses netsh for SSID detection.
+Windows version — uses the WLAN API for SSID detection (netsh as a fallback).
+Also runs on Linux, reading network state straight from the kernel.
 Credentials stored in config.json next to this script.
 """
 
-import subprocess
+import atexit
+import enum
+import io
 import json
 import time
 import os
 import sys
-import urllib.request
+import queue
+import random
+import re
+import select
+import socket
+import struct
+import threading
 import urllib.parse
-from xml.etree import ElementTree
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 PORTAL_BASE = "http://172.24.66.1:8090"
+LOGIN_PATH = "/login.xml"
+LIVE_PATH = "/live"
+# One field of a portal reply, e.g. <status><![CDATA[LIVE]]></status>
+XML_FIELD = r"<{0}>\s*(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))\s*</{0}>"
 TARGET_SSID = "NUJS-CAMPUS WiFi"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.json")
 LOG_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-login.log")
+EVENTS_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-events.jsonl")
+STATS_FILE = os.path.join(SCRIPT_DIR, "stats.json")
+# New samples are appended here and merged into STATS_FILE now and then
+STATS_JOURNAL = os.path.join(SCRIPT_DIR, "stats.jsonl")
+BACKOFF_FILE = os.path.join(SCRIPT_DIR, "login-backoff.json")
+STATE_FILE = os.path.join(SCRIPT_DIR, "state.json")
+NETWORKS_FILE = os.path.join(SCRIPT_DIR, "networks.json")
+TRACE_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-trace.jsonl")
+RUN_LOCK_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-login.lock")
+DAEMON_LOCK_FILE = os.path.join(SCRIPT_DIR, "nujs-wifi-daemon.lock")
+# The daemon's local control endpoint (status, change stream, "log in now")
+CONTROL_SOCKET = os.path.join(SCRIPT_DIR, "nujs-wifi-login.sock")
+CONTROL_PIPE = r"\\.\pipe\nujs-wifi-login"
+# Encrypted-file credential store, for systems without an OS secret store
+SECRETS_FILE = os.path.join(SCRIPT_DIR, "secrets.json")
+SECRETS_KEY_FILE = os.path.join(SCRIPT_DIR, "secrets.key")
+
+# Log files rotate to .1 .. .LOG_KEEP past LOG_MAX_BYTES or LOG_MAX_AGE seconds;
+# buffered lines are written within LOG_FLUSH_INTERVAL seconds (and at exit)
+LOG_MAX_BYTES = 1024 * 1024
+LOG_MAX_AGE = 30 * 24 * 3600
+LOG_KEEP = 5
+LOG_FLUSH_INTERVAL = 2
+# Phase latency histograms: bucket upper bounds in ms, kept per hour for
+# STATS_RETENTION_DAYS so `stats --window` can pick any recent span
+STATS_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+STATS_RETENTION_DAYS = 90
+# Each process appends its samples to STATS_JOURNAL at exit (the daemon after
+# every loop); the journal is folded into STATS_FILE every
+# STATS_COMPACT_INTERVAL seconds by the daemon, or once it grows past
+# STATS_JOURNAL_MAX_BYTES
+STATS_COMPACT_INTERVAL = 600
+STATS_JOURNAL_MAX_BYTES = 256 * 1024
+STATS_PHASES = ["time_to_internet", "run", "ssid", "probe", "portal_wait", "credentials", "login", "keepalive",
+               "link", "health", "drop_detect"]
+
+CAPTIVE_PROBE_URL = "http://captive.apple.com/hotspot-detect.html"
+# (url, expected HTTP status, expected body text) - any one answering as expected means we're online
+CONNECTIVITY_PROBES = [
+    (CAPTIVE_PROBE_URL, 200, "Success"),
+    ("http://connectivitycheck.gstatic.com/generate_204", 204, ""),
+    ("http://www.msftconnecttest.com/connecttest.txt", 200, "Microsoft Connect Test"),
+]
+PROBE_TIMEOUT = 5
+# Known addresses of probe hosts, so probing needs no DNS: behind a captive
+# portal DNS is often intercepted, slow or hijacked. The request goes straight
+# to the address with the name in the Host header. Other hosts are looked up
+# once and the answer kept for RESOLVE_TTL seconds, but only after a probe
+# through it got the expected reply, so a hijacked answer never sticks.
+PINNED_ADDRESSES = {
+    "www.msftconnecttest.com": ["13.107.4.52"],
+}
+RESOLVE_TTL = 600
+# Portals found from captive redirects are remembered per network this long.
+# Only a redirect that looks like Sophos (its port or its login page) counts,
+# and it is only used on the NUJS network once it has answered like Sophos.
+PORTAL_CACHE_TTL = 7 * 24 * 3600
+SOPHOS_PORT = 8090
+SOPHOS_PAGE = "/httpclient.html"
+# What each network turned out to be is kept in NETWORKS_FILE, keyed by SSID,
+# gateway IP and MAC and subnet, for the NETWORK_DB_SIZE most recently seen
+# networks. One found without the portal is skipped without any probes for
+# NETWORK_NEGATIVE_TTL seconds (override with "negative_cache_seconds"), but
+# only after NETWORK_NEGATIVE_MISSES visits in a row without it, and never on
+# TARGET_SSID.
+NETWORK_DB_SIZE = 64
+NETWORK_NEGATIVE_TTL = 24 * 3600
+NETWORK_NEGATIVE_MISSES = 3
+# A new network whose internet already works gets this long to show whether
+# the portal is there too
+NETWORK_LEARN_TIMEOUT = 1
+# On a network known to have the portal, one probe this quick tells whether
+# the session is still live before any login POST
+ONLINE_CHECK_TIMEOUT = 1
+META_REFRESH = re.compile(
+    r"""<meta[^>]+http-equiv=["']?refresh["']?[^>]*?content=["']?[^"'>]*?url=([^"'>\s]+)""",
+    re.IGNORECASE)
+# Portal readiness wait: TCP-connect probes starting at PORTAL_WAIT_FIRST seconds
+# apart, doubling (with jitter) up to PORTAL_WAIT_MAX, giving up after the deadline
+PORTAL_WAIT_DEADLINE = 30
+PORTAL_WAIT_FIRST = 0.2
+PORTAL_WAIT_MAX = 3
+# Other interfaces towards the portal (see "all_interfaces" in config.json) get
+# this long for the portal to answer: by then the default route has found it.
+# One where it didn't is left alone for LINK_RETRY seconds.
+LINK_PORTAL_WAIT = 3
+LINK_RETRY = 3600
+# Daemon mode: how often to look for network changes, and how often to re-check
+# the session even when nothing changed
+DAEMON_POLL = 2
+DAEMON_RECHECK = 60
+# Linux: kernel address/route/link events wake the daemon at once. A burst is
+# handled once the kernel has been quiet for NETLINK_DEBOUNCE seconds (link
+# flaps, DHCP's address + route pair), but never later than NETLINK_DEBOUNCE_MAX
+NETLINK_DEBOUNCE = 0.1
+NETLINK_DEBOUNCE_MAX = 1
+# Keepalive: idle seconds before the portal drops a session (override with
+# "session_timeout" in config.json). Live requests go out every half timeout,
+# +/- KEEPALIVE_JITTER, and are retried after KEEPALIVE_RETRY on network errors.
+SESSION_TIMEOUT = 360
+KEEPALIVE_JITTER = 0.1
+KEEPALIVE_RETRY = 15
+# Session health monitor (daemon): while logged in, a TCP connect to a probe
+# host's HTTPS port, which the portal blocks for clients without a session
+# (port 80 it intercepts). Checks start HEALTH_MIN seconds apart after a login
+# and stretch by HEALTH_BACKOFF up to HEALTH_MAX while they pass. A failed
+# connect is only a suspicion: an HTTP probe has to confirm it before logging
+# in again. Worst case a drop is noticed HEALTH_MAX + HEALTH_TIMEOUT +
+# PROBE_TIMEOUT seconds after the last good check. A false alarm (connect
+# failed, internet fine) doubles the interval; after HEALTH_FALSE_ALARMS in a
+# row the target is taken to be filtered on this network and the monitor
+# leaves it to the keepalives and periodic checks.
+HEALTH_MIN = 2
+HEALTH_MAX = 20
+HEALTH_BACKOFF = 1.5
+HEALTH_FALSE_ALARMS = 3
+HEALTH_TIMEOUT = 1
+HEALTH_PORT = 443
+# A run within STATE_FRESH seconds of a good check on the same network exits
+# without touching the network (override with "state_fresh_seconds")
+STATE_FRESH = 30
+# How long a run waits for a concurrent run's outcome before giving up
+RUN_LOCK_WAIT = 120
+# Transient login failures are retried up to LOGIN_RETRY_BUDGET attempts,
+# starting LOGIN_RETRY_DELAY seconds apart and doubling
+LOGIN_RETRY_BUDGET = 3
+LOGIN_RETRY_DELAY = 1
+# Login POST timing, learned per network from the portal's recent reply times
+# (networks.json): a second POST goes out on a fresh connection once the first
+# has run past their 95th percentile, and the timeout follows the slowest of
+# them. The defaults apply until LOGIN_MIN_SAMPLES replies have been seen.
+LOGIN_TIMEOUT = 10
+LOGIN_TIMEOUT_MIN = 2
+LOGIN_HEDGE_AFTER = 1.5
+LOGIN_HEDGE_MIN = 0.1
+LOGIN_SAMPLES = 32
+LOGIN_MIN_SAMPLES = 5
+# Batch mode (a roster of accounts, e.g. lab machines and kiosks): logins in
+# flight at once, and portal requests per second shared by all of them
+BATCH_PARALLEL = 8
+BATCH_RATE = 10
+# The password lives in a credential store ("credential_store" in config.json,
+# default "auto": the OS secret store, else an encrypted file) under this
+# service name. Fetched passwords stay in memory this long, or until the
+# portal rejects them.
+CREDENTIAL_SERVICE = "nujs-wifi-autologin"
+CREDENTIAL_TTL = 12 * 3600
+
+
+class PortalState(enum.Enum):
+    LIVE = "live"
+    ALREADY_LIVE = "already logged in"
+    WRONG_PASSWORD = "wrong password"
+    LIMIT_REACHED = "max login limit reached"
+    QUOTA_EXCEEDED = "data quota exceeded"
+    ACCOUNT_BLOCKED = "account disabled or expired"
+    TRANSIENT = "transient failure"
+
+
+SUCCESS_STATES = (PortalState.LIVE, PortalState.ALREADY_LIVE)
+# Terminal states: seconds to stay away from the portal with the same credentials
+TERMINAL_BACKOFF = {
+    PortalState.WRONG_PASSWORD: 6 * 3600,
+    PortalState.LIMIT_REACHED: 15 * 60,
+    PortalState.QUOTA_EXCEEDED: 6 * 3600,
+    PortalState.ACCOUNT_BLOCKED: 24 * 3600,
+}
+# Lower-case message fragments the Sophos portal uses for each state
+PORTAL_MESSAGES = [
+    ("invalid user name/password", PortalState.WRONG_PASSWORD),
+    ("invalid username", PortalState.WRONG_PASSWORD),
+    ("incorrect password", PortalState.WRONG_PASSWORD),
+    ("maximum login limit", PortalState.LIMIT_REACHED),
+    ("max login limit", PortalState.LIMIT_REACHED),
+    ("data transfer has been exceeded", PortalState.QUOTA_EXCEEDED),
+    ("quota", PortalState.QUOTA_EXCEEDED),
+    ("expired", PortalState.ACCOUNT_BLOCKED),
+    ("disabled", PortalState.ACCOUNT_BLOCKED),
+    ("locked", PortalState.ACCOUNT_BLOCKED),
+    ("already", PortalState.ALREADY_LIVE),
+]
+
+
+class _Connection:
+    # Just enough HTTP/1.1 for the portal's and the probes' small replies,
+    # straight over a socket. Every trigger is a cold start, and http.client
+    # would pull in email, ssl and friends before the first packet goes out.
+
+    def __init__(self, host, port, timeout, source=None, address=None):
+        # With address, connect there and only name host in the Host header
+        self.host = host if port == 80 else f"{host}:{port}"
+        target = address or host
+        # getaddrinfo() runs str hosts through the idna codec (another import);
+        # plain ASCII names and IP literals can go in as bytes
+        target = (target.encode("ascii") if target.isascii() else target, port)
+        self.sock = socket.create_connection(target, timeout, (source, 0) if source else None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self.sock.makefile("rb")
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def request(self, method, path, body, headers):
+        # Returns (status, headers with lower-case names, body, will_close)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", "Accept-Encoding: identity"]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+
+        status_line = self._reader.readline(65537)
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        version, status = status_line.split(None, 2)[:2]
+        status = int(status)
+        reply = {}
+        while True:
+            line = self._reader.readline(65537)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            reply[name.strip().lower()] = value.strip()
+
+        connection = reply.get("connection", "").lower()
+        will_close = connection == "close" or (version == b"HTTP/1.0" and connection != "keep-alive")
+        if method == "HEAD" or status in (204, 304) or status < 200:
+            data = b""
+        elif "chunked" in reply.get("transfer-encoding", "").lower():
+            data = self._read_chunked()
+        elif "content-length" in reply:
+            length = int(reply["content-length"])
+            data = self._reader.read(length)
+            if len(data) < length:
+                raise ConnectionError("connection closed mid-body")
+        else:
+            data = self._reader.read()
+            will_close = True
+        return status, reply, data, will_close
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self._reader.readline(65537).split(b";")[0], 16)
+            if size == 0:
+                while self._reader.readline(65537) not in (b"\r\n", b"\n", b""):
+                    pass  # trailers
+                return b"".join(chunks)
+            chunks.append(self._reader.read(size))
+            self._reader.readline(65537)
+
+    def close(self):
+        self._reader.close()
+        self.sock.close()
+
+
+class _TLSConnection:
+    # https (only ever a discovered portal) goes through http.client, imported
+    # on first use so plain-HTTP runs never pay for it
+
+    def __init__(self, host, port, timeout, source=None):
+        import http.client
+        self._errors = (http.client.HTTPException,)
+        self._conn = http.client.HTTPSConnection(host, port, timeout=timeout,
+                                                 source_address=(source, 0) if source else None)
+
+    def settimeout(self, timeout):
+        if self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+
+    def request(self, method, path, body, headers):
+        try:
+            self._conn.request(method, path, body=body, headers=headers)
+            resp = self._conn.getresponse()
+            data = resp.read()
+        except self._errors as e:
+            raise ConnectionError(str(e)) from e
+        return resp.status, {name.lower(): value for name, value in resp.getheaders()}, data, resp.will_close
+
+    def close(self):
+        self._conn.close()
+
+
+class HTTPPool:
+    # One keep-alive connection per host, shared by every request in this
+    # process (a single run or the whole daemon lifetime). A connection the
+    # server closed while idle is replaced transparently. With a source
+    # address, every connection is bound to it (batch mode, per-account IPs).
+
+    def __init__(self, source=None):
+        self.source = source
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, timeout=10, address=None):
+        # Returns (status, headers with lower-case names, body). address
+        # (plain http only) connects to that IP instead of resolving the host.
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        with self._lock:
+            entry = self._conns.setdefault((parts.scheme, parts.netloc, address), [None, threading.Lock()])
+
+        with entry[1]:
+            while True:
+                conn = entry[0]
+                fresh = conn is None
+                try:
+                    if fresh:
+                        if parts.scheme == "https":
+                            conn = _TLSConnection(parts.hostname, parts.port or 443, timeout, self.source)
+                        else:
+                            conn = _Connection(parts.hostname, parts.port or 80, timeout, self.source, address)
+                        entry[0] = conn
+                    else:
+                        conn.settimeout(timeout)
+                    status, reply, data, will_close = conn.request(method, path, body, headers or {})
+                except (OSError, ValueError) as e:
+                    if conn is not None:
+                        conn.close()
+                    entry[0] = None
+                    # A reused connection may have died unseen (server closed
+                    # it, NAT entry expired during sleep): retry once on a
+                    # fresh one. A timeout only for GETs, which are safe to repeat.
+                    if fresh or (isinstance(e, socket.timeout) and method != "GET"):
+                        raise
+                    continue
+                if will_close:
+                    conn.close()
+                    entry[0] = None
+                return status, reply, data
+
+    def close(self):
+        with self._lock:
+            for entry in self._conns.values():
+                if entry[0] is not None:
+                    entry[0].close()
+            self._conns.clear()
+
+
+HTTP = HTTPPool()
+
+
+class FileLock:
+    # Advisory lock on a file, released by the OS if the holder dies.
+    # msvcrt byte-range lock on Windows, flock() elsewhere.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, timeout=0):
+        deadline = time.monotonic() + timeout
+        f = open(self.path, "a+")
+        while True:
+            try:
+                if os.name == "nt":
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    f.close()
+                    return False
+                time.sleep(0.05)
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            if os.name == "nt":
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+class RotatingLog:
+    # Append-only log kept open between writes. Lines are buffered and written
+    # in batches; the file rotates to path.1 .. path.keep once it outgrows
+    # max_bytes or its first line is older than max_age.
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE, keep=LOG_KEEP):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self._file = None
+        self._created = None
+        self._buffer = []
+        self._buffered_at = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        with self._lock:
+            if not self._buffer:
+                self._buffered_at = time.monotonic()
+            self._buffer.append(line + "\n")
+            if len(self._buffer) >= 64 or time.monotonic() - self._buffered_at >= LOG_FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._created = _first_timestamp(self.path) or time.time()
+            if self._file.tell() >= self.max_bytes or time.time() - self._created >= self.max_age:
+                self._rotate()
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+        except Exception:
+            pass
+        self._buffer = []
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        try:
+            for i in range(self.keep - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        except OSError:
+            pass  # e.g. another process has it open on Windows; try again later
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._created = _first_timestamp(self.path) or time.time()
+
+
+def _first_timestamp(path):
+    # Time of the first line of a text ("YYYY-mm-dd HH:MM:SS ...") or JSONL log
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            first = f.readline()
+        if first.startswith("{"):
+            return json.loads(first)["ts"]
+        # Sliced by hand: time.strptime costs a 5 ms import on every run
+        fields = [int(first[a:b]) for a, b in ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19))]
+        return time.mktime(tuple(fields) + (0, 0, -1))
+    except Exception:
+        return None
+
+
+def tail(path, n=10, block=4096):
+    # Last n lines, read backwards from the end: cost doesn't grow with the file
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b""
+            while pos > 0 and data.count(b"\n") <= n:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+    except OSError:
+        return []
+    return data.decode("utf-8", errors="replace").splitlines()[-n:]
+
+
+def recent_events(n=10):
+    events = []
+    for line in tail(EVENTS_FILE, n):
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            pass
+    return events
+
+
+_logs = {}
+
+
+def _log_file(path):
+    if path not in _logs:
+        _logs[path] = RotatingLog(path)
+    return _logs[path]
+
+
+def flush_logs():
+    for f in list(_logs.values()):
+        f.flush()
+
+
+atexit.register(flush_logs)
 
 
 def log(msg):
     ts = time.strftime("%Y-%m-%d %H:%M:%S")
     line = f"{ts} {msg}"
     print(line)
+    _log_file(LOG_FILE).write(line)
+
+
+def event(phase, ok=None, **fields):
+    # One structured record per phase of a run, with its timing. Timed phases
+    # also feed the latency histograms.
+    record = {"ts": round(time.time(), 3), "phase": phase, "ok": ok}
+    record.update(fields)
+    _log_file(EVENTS_FILE).write(json.dumps(record, separators=(",", ":")))
+    if "ms" in fields:
+        observe(phase, fields["ms"], ok is not False)
+
+
+_tracing = False
+
+
+def configure_tracing(cfg):
+    global _tracing
+    _tracing = bool(cfg.get("trace"))
+
+
+def trace(kind, **fields):
+    # Replay trace for simulate.py, only with "trace": true in config.json:
+    # network transitions, each probe, portal connect, login POST and
+    # keepalive with its latency. Compact keys, one JSON object per line.
+    if not _tracing:
+        return
+    record = {"t": round(time.time(), 3), "k": kind}
+    record.update(fields)
+    _log_file(TRACE_FILE).write(json.dumps(record, separators=(",", ":")))
+
+
+_pending_stats = {}
+
+
+def observe(phase, ms, ok=True):
+    # Buffered in memory; appended to STATS_JOURNAL by save_stats()
+    slot = str(int(time.time() // 3600))
+    h = _pending_stats.setdefault(phase, {}).setdefault(slot, _empty_histogram())
+    _add_to_histogram(h, ms, ok)
+
+
+def _empty_histogram():
+    return {"buckets": [0] * (len(STATS_BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0, "failures": 0}
+
+
+def _add_to_histogram(h, ms, ok):
+    i = 0
+    while i < len(STATS_BUCKETS) and ms > STATS_BUCKETS[i]:
+        i += 1
+    h["buckets"][i] += 1
+    h["count"] += 1
+    h["sum"] += ms
+    h["max"] = max(h["max"], ms)
+    if not ok:
+        h["failures"] += 1
+
+
+def _merge_histogram(into, h):
+    into["buckets"] = [a + b for a, b in zip(into["buckets"], h["buckets"])]
+    into["count"] += h["count"]
+    into["sum"] += h["sum"]
+    into["max"] = max(into["max"], h["max"])
+    into["failures"] += h["failures"]
+
+
+def _read_stats_file():
     try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
+        with open(STATS_FILE, "r") as f:
+            return json.load(f)
     except Exception:
+        return {}
+
+
+def _merge_journal(stats):
+    # Fold every complete line of STATS_JOURNAL into stats, in place
+    try:
+        with open(STATS_JOURNAL, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    for line in lines:
+        try:
+            pending = json.loads(line)
+        except ValueError:
+            continue  # cut short by a crash mid-append
+        for phase, slots in pending.items():
+            saved = stats.setdefault(phase, {})
+            for slot, h in slots.items():
+                _merge_histogram(saved.setdefault(slot, _empty_histogram()), h)
+
+
+def load_stats():
+    stats = _read_stats_file()
+    _merge_journal(stats)
+    return stats
+
+
+_stats_compacted_at = time.monotonic()
+
+
+def save_stats(cfg=None):
+    # Appends the buffered samples to STATS_JOURNAL: a few hundred bytes,
+    # where rewriting STATS_FILE means loading and dumping months of
+    # histograms. The rewrite happens in compact_stats() instead.
+    global _pending_stats
+    lock = FileLock(STATS_FILE + ".lock")
+    if _pending_stats and lock.acquire(timeout=1):
+        try:
+            with open(STATS_JOURNAL, "a") as f:
+                f.write(json.dumps(_pending_stats, separators=(",", ":")) + "\n")
+            _pending_stats = {}
+        except OSError:
+            pass
+        finally:
+            lock.release()
+    try:
+        journal_size = os.path.getsize(STATS_JOURNAL)
+    except OSError:
+        return
+    if (journal_size > STATS_JOURNAL_MAX_BYTES
+            or time.monotonic() - _stats_compacted_at >= STATS_COMPACT_INTERVAL):
+        compact_stats(cfg)
+
+
+def compact_stats(cfg=None):
+    # Merges STATS_JOURNAL into STATS_FILE (tmp file, then os.replace, so a
+    # crash leaves the old file whole) and drops slots past retention. The
+    # lock keeps appends out between reading the journal and removing it.
+    global _stats_compacted_at
+    _stats_compacted_at = time.monotonic()
+    lock = FileLock(STATS_FILE + ".lock")
+    if not lock.acquire(timeout=1):
+        return
+    try:
+        stats = load_stats()
+        oldest = int(time.time() // 3600) - STATS_RETENTION_DAYS * 24
+        for saved in stats.values():
+            for slot in [k for k in saved if int(k) < oldest]:
+                del saved[slot]
+        tmp = STATS_FILE + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp, STATS_FILE)
+            os.remove(STATS_JOURNAL)
+        except OSError:
+            return
+    finally:
+        lock.release()
+    textfile = (cfg or {}).get("prometheus_textfile")
+    if textfile:
+        write_prometheus(stats, textfile)
+
+
+def summarize_stats(stats, window_hours):
+    # {phase: merged histogram} over the last window_hours
+    first = int(time.time() // 3600) - window_hours + 1
+    summary = {}
+    for phase, slots in stats.items():
+        merged = _empty_histogram()
+        for slot, h in slots.items():
+            if int(slot) >= first:
+                _merge_histogram(merged, h)
+        if merged["count"]:
+            summary[phase] = merged
+    return summary
+
+
+def histogram_percentile(h, pct):
+    # Upper bound of the bucket holding the pct-th sample (capped at the max seen)
+    rank = h["count"] * pct / 100
+    seen = 0
+    for i, n in enumerate(h["buckets"]):
+        seen += n
+        if n and seen >= rank:
+            return min(STATS_BUCKETS[i], h["max"]) if i < len(STATS_BUCKETS) else h["max"]
+    return h["max"]
+
+
+def write_prometheus(stats, path):
+    # Node exporter textfile collector format, all-time totals
+    lines = [
+        "# HELP nujs_wifi_phase_duration_ms Time spent in each login phase.",
+        "# TYPE nujs_wifi_phase_duration_ms histogram",
+    ]
+    failures = []
+    for phase, h in summarize_stats(stats, STATS_RETENTION_DAYS * 24).items():
+        cumulative = 0
+        for bound, n in zip(STATS_BUCKETS + ["+Inf"], h["buckets"]):
+            cumulative += n
+            lines.append(f'nujs_wifi_phase_duration_ms_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'nujs_wifi_phase_duration_ms_sum{{phase="{phase}"}} {h["sum"]:.1f}')
+        lines.append(f'nujs_wifi_phase_duration_ms_count{{phase="{phase}"}} {h["count"]}')
+        failures.append(f'nujs_wifi_phase_failures_total{{phase="{phase}"}} {h["failures"]}')
+    lines += ["# HELP nujs_wifi_phase_failures_total Failed attempts of each login phase.",
+              "# TYPE nujs_wifi_phase_failures_total counter"] + failures
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+    except OSError:
         pass
 
 
+def print_stats(window):
+    units = {"h": 1, "d": 24, "w": 24 * 7}
+    try:
+        hours = int(window[:-1]) * units[window[-1]]
+    except (KeyError, ValueError):
+        print(f"[!] Bad window '{window}'. Use e.g. 12h, 7d or 4w.")
+        return
+    summary = summarize_stats(load_stats(), hours)
+    if not summary:
+        print(f"[*] No timings recorded in the last {window}.")
+        return
+    print(f"Last {window}:")
+    print(f"{'phase':<18}{'count':>7}{'fail %':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for phase in STATS_PHASES + sorted(set(summary) - set(STATS_PHASES)):
+        h = summary.get(phase)
+        if not h:
+            continue
+        print(f"{phase:<18}{h['count']:>7}{100 * h['failures'] / h['count']:>8.1f}"
+              f"{histogram_percentile(h, 50):>10.0f}{histogram_percentile(h, 95):>10.0f}{h['max']:>10.0f}")
+
+
 def load_config():
     try:
         with open(CONFIG_FILE, "r") as f:
@@ -39,35 +776,1229 @@ def load_config():
         return {}
 
 
-def get_wifi_ssid():
+# ---- Credentials ----
+# Where the password is kept, behind one interface so each platform can use
+# its own secret store. config.json holds only the username and the store's
+# name; a "password" still in it (older setups) is used as is.
+
+class CredentialStore:
+    name = None
+    auto = True  # a candidate for "credential_store": "auto"
+
+    def available(self):
+        return True
+
+    def get(self, username):
+        raise NotImplementedError
+
+    def set(self, username, password):
+        raise NotImplementedError
+
+    def delete(self, username):
+        raise NotImplementedError
+
+
+class WindowsCredentialStore(CredentialStore):
+    # Credential Manager, one generic credential per user
+    name = "wincred"
+    CRED_TYPE_GENERIC = 1
+    CRED_PERSIST_LOCAL_MACHINE = 2
+
+    def available(self):
+        return os.name == "nt"
+
+    def _advapi32(self):
+        advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+        advapi32.CredReadW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD,
+                                       ctypes.POINTER(ctypes.POINTER(_CREDENTIAL))]
+        advapi32.CredWriteW.argtypes = [ctypes.POINTER(_CREDENTIAL), wintypes.DWORD]
+        advapi32.CredDeleteW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD]
+        advapi32.CredFree.argtypes = [ctypes.c_void_p]
+        return advapi32
+
+    def get(self, username):
+        advapi32 = self._advapi32()
+        found = ctypes.POINTER(_CREDENTIAL)()
+        if not advapi32.CredReadW(f"{CREDENTIAL_SERVICE}:{username}", self.CRED_TYPE_GENERIC, 0,
+                                  ctypes.byref(found)):
+            return None
+        try:
+            cred = found.contents
+            return ctypes.string_at(cred.CredentialBlob, cred.CredentialBlobSize).decode("utf-16-le")
+        finally:
+            advapi32.CredFree(found)
+
+    def set(self, username, password):
+        blob = password.encode("utf-16-le")
+        buf = (ctypes.c_ubyte * len(blob)).from_buffer_copy(blob)
+        cred = _CREDENTIAL(Type=self.CRED_TYPE_GENERIC, TargetName=f"{CREDENTIAL_SERVICE}:{username}",
+                           UserName=username, Persist=self.CRED_PERSIST_LOCAL_MACHINE,
+                           CredentialBlobSize=len(blob),
+                           CredentialBlob=ctypes.cast(buf, ctypes.POINTER(ctypes.c_ubyte)))
+        if not self._advapi32().CredWriteW(ctypes.byref(cred), 0):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def delete(self, username):
+        self._advapi32().CredDeleteW(f"{CREDENTIAL_SERVICE}:{username}", self.CRED_TYPE_GENERIC, 0)
+
+
+class KeychainStore(CredentialStore):
+    # macOS login keychain, through the security tool
+    name = "keychain"
+
+    def available(self):
+        return sys.platform == "darwin"
+
+    def _security(self, *args):
+        import subprocess
+        return subprocess.run(["security", *args, "-s", CREDENTIAL_SERVICE],
+                              capture_output=True, text=True, timeout=30)
+
+    def get(self, username):
+        r = self._security("find-generic-password", "-a", username, "-w")
+        return r.stdout.rstrip("\n") if r.returncode == 0 else None
+
+    def set(self, username, password):
+        r = self._security("add-generic-password", "-U", "-a", username, "-w", password)
+        if r.returncode != 0:
+            raise OSError(r.stderr.strip() or "security add-generic-password failed")
+
+    def delete(self, username):
+        self._security("delete-generic-password", "-a", username)
+
+
+class SecretServiceStore(CredentialStore):
+    # The desktop keyring on Linux (GNOME Keyring, KWallet) through libsecret's
+    # secret-tool; needs a session bus, so not for headless machines
+    name = "secret-service"
+
+    def available(self):
+        import shutil
+        return (sys.platform.startswith("linux") and "DBUS_SESSION_BUS_ADDRESS" in os.environ
+                and shutil.which("secret-tool") is not None)
+
+    def _secret_tool(self, *args, secret=None):
+        import subprocess
+        return subprocess.run(["secret-tool", *args, "service", CREDENTIAL_SERVICE],
+                              input=secret, capture_output=True, text=True, timeout=30)
+
+    def get(self, username):
+        r = self._secret_tool("lookup", "username", username)
+        if r.returncode != 0:
+            return None
+        return r.stdout.rstrip("\n") or None
+
+    def set(self, username, password):
+        r = self._secret_tool("store", "--label=NUJS WiFi auto-login", "username", username, secret=password)
+        if r.returncode != 0:
+            raise OSError(r.stderr.strip() or "secret-tool store failed")
+
+    def delete(self, username):
+        self._secret_tool("clear", "username", username)
+
+
+class EncryptedFileStore(CredentialStore):
+    # Passwords encrypted under a random key kept in a separate owner-only
+    # file: HMAC-SHA256 in counter mode as the keystream, then an HMAC tag
+    # over nonce and ciphertext (the standard library has no block cipher).
+    # Keeps the password out of config.json, logs and casual copies; anyone
+    # who can read both files as this user can still decrypt it.
+    name = "file"
+
+    def _key(self, create=False):
+        try:
+            with open(SECRETS_KEY_FILE, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            if not create:
+                return None
+        key = os.urandom(32)
+        fd = os.open(SECRETS_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            try:
+                self._owner_only(SECRETS_KEY_FILE)
+            except OSError:
+                f.close()
+                os.remove(SECRETS_KEY_FILE)
+                raise
+            f.write(key)
+        return key
+
+    @staticmethod
+    def _owner_only(path):
+        # The 0o600 given to os.open() means nothing on Windows, where the
+        # file would inherit the folder's ACL (often readable by all users):
+        # replace it with one granting only this user access. Called before
+        # anything secret is written.
+        if os.name != "nt":
+            return
+        import subprocess
+        user = os.environ.get("USERNAME", "")
+        if os.environ.get("USERDOMAIN"):
+            user = f"{os.environ['USERDOMAIN']}\\{user}"
+        r = subprocess.run(["icacls", path, "/inheritance:r", "/grant:r", f"{user}:F"],
+                           capture_output=True, text=True)
+        if r.returncode != 0:
+            raise OSError(f"can't restrict access to {path}: {(r.stdout + r.stderr).strip()}")
+
+    def _load(self):
+        try:
+            with open(SECRETS_FILE, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save(self, secrets):
+        tmp = SECRETS_FILE + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            self._owner_only(tmp)  # the ACL moves with the file on replace
+            json.dump(secrets, f)
+        os.replace(tmp, SECRETS_FILE)
+
+    @staticmethod
+    def _crypt(key, nonce, data):
+        import hashlib
+        import hmac
+        stream = b"".join(hmac.new(key, b"enc" + nonce + i.to_bytes(8, "big"), hashlib.sha256).digest()
+                          for i in range((len(data) + 31) // 32))
+        return bytes(a ^ b for a, b in zip(data, stream))
+
+    @staticmethod
+    def _tag(key, data):
+        import hashlib
+        import hmac
+        return hmac.new(key, b"mac" + data, hashlib.sha256).digest()
+
+    def get(self, username):
+        import base64
+        import hmac
+        key = self._key()
+        sealed = self._load().get(username)
+        if key is None or sealed is None:
+            return None
+        sealed = base64.b64decode(sealed)
+        nonce, body, tag = sealed[:16], sealed[16:-32], sealed[-32:]
+        if not hmac.compare_digest(tag, self._tag(key, nonce + body)):
+            raise ValueError(f"{SECRETS_FILE} was modified or its key changed")
+        return self._crypt(key, nonce, body).decode("utf-8")
+
+    def set(self, username, password):
+        import base64
+        key = self._key(create=True)
+        nonce = os.urandom(16)
+        body = self._crypt(key, nonce, password.encode("utf-8"))
+        secrets = self._load()
+        secrets[username] = base64.b64encode(nonce + body + self._tag(key, nonce + body)).decode("ascii")
+        self._save(secrets)
+
+    def delete(self, username):
+        secrets = self._load()
+        if secrets.pop(username, None) is not None:
+            self._save(secrets)
+
+
+class PlainConfigStore(CredentialStore):
+    # The password in config.json, as older setups wrote it. Only on request.
+    name = "config"
+    auto = False
+
+    def get(self, username):
+        return load_config().get("password") or None
+
+    def set(self, username, password):
+        save_config(dict(load_config(), username=username, password=password))
+
+    def delete(self, username):
+        cfg = load_config()
+        if cfg.pop("password", None) is not None:
+            save_config(cfg)
+
+
+CREDENTIAL_STORES = [WindowsCredentialStore, KeychainStore, SecretServiceStore, EncryptedFileStore,
+                     PlainConfigStore]
+_password_cache = {}  # username -> (password, expires)
+
+
+def credential_store(cfg):
+    wanted = cfg.get("credential_store", "auto")
+    for cls in CREDENTIAL_STORES:
+        store = cls()
+        if store.name == wanted or (wanted == "auto" and store.auto and store.available()):
+            return store
+    raise ValueError(f"unknown credential_store '{wanted}'")
+
+
+def get_password(cfg):
+    # The password for cfg's username: from memory while fresh, else from its
+    # store. Returns "" if there is none.
+    if cfg.get("password"):
+        return cfg["password"]
+    username = cfg.get("username", "")
+    if not username:
+        return ""
+    cached = _password_cache.get(username)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        password = credential_store(cfg).get(username)
+    except Exception as e:
+        log(f"[!] Could not read the password from the credential store: {e}")
+        password = None
+    if password:
+        _password_cache[username] = (password, time.monotonic() + cfg.get("credential_ttl", CREDENTIAL_TTL))
+    return password or ""
+
+
+def forget_password(username):
+    # Next get_password() goes back to the store, e.g. after setup changed it
+    _password_cache.pop(username, None)
+
+
+def save_config(cfg):
+    tmp = CONFIG_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cfg, f)
+    os.replace(tmp, CONFIG_FILE)
+
+
+def store_credentials(username, password, store_name="auto"):
+    # Save the password in a credential store and point config.json at it,
+    # dropping any plaintext password. Returns the store used.
+    cfg = load_config()
+    cfg.pop("password", None)
+    cfg.update(username=username, credential_store=store_name)
+    store = credential_store(cfg)
+    store.set(username, password)
+    cfg["credential_store"] = store.name
+    if store.name != "config":
+        save_config(cfg)
+    forget_password(username)
+    return store
+
+
+def set_password_interactive(store_name):
+    import getpass
+    cfg = load_config()
+    username = input(f"NUJS username [{cfg.get('username', '')}]: ").strip() or cfg.get("username", "")
+    password = getpass.getpass("NUJS password: ")
+    if not username or not password:
+        print("[!] Username and password are required.")
+        return False
+    store = store_credentials(username, password, store_name or cfg.get("credential_store", "auto"))
+    clear_backoff()
+    print(f"[+] Password saved ({store.name}); config.json no longer holds it.")
+    return True
+
+
+# ---- Network state providers ----
+# SSID, gateway and interface lookups sit behind a provider so each platform
+# can use its cheapest source, and so results can be cached until the network
+# actually changes.
+
+class NetworkProvider:
+    # Base provider: no SSID/gateway information. Subclasses override the
+    # _ssid/_gateway/_interfaces lookups and, if the platform can tell them,
+    # change_key(), which must return a new value whenever the network changes.
+
+    CACHE_TTL = 60
+
+    def __init__(self):
+        self._cache = {}
+        self._cache_key = None
+        self._cache_time = 0.0
+
+    def change_key(self):
+        return network_signature()
+
+    def _cached(self, name, lookup):
+        key = self.change_key()
+        now = time.monotonic()
+        if key != self._cache_key or now - self._cache_time > self.CACHE_TTL:
+            self._cache = {}
+            self._cache_key = key
+            self._cache_time = now
+        if name not in self._cache:
+            try:
+                self._cache[name] = lookup()
+            except Exception:
+                self._cache[name] = None
+        return self._cache[name]
+
+    def ssid(self):
+        return self._cached("ssid", self._ssid)
+
+    def gateway(self):
+        # (gateway ip or None if directly connected, interface) towards the portal
+        return self._cached("gateway", self._gateway)
+
+    def interfaces(self):
+        # [{"name", "up", "wireless"}]
+        return self._cached("interfaces", self._interfaces) or []
+
+    def gateway_mac(self):
+        # MAC of the next hop towards the portal (the portal itself when
+        # it is directly connected), from the OS neighbour cache
+        return self._cached("gateway_mac", self._gateway_mac)
+
+    def portal_links(self):
+        # [{"name", "address"}]: every interface with a route towards the
+        # portal and the IPv4 address to bind to for it
+        return self._cached("portal_links", self._portal_links) or []
+
+    def _next_hop(self):
+        route = self.gateway()
+        if not route:
+            return None
+        return route[0] or urllib.parse.urlsplit(PORTAL_BASE).hostname
+
+    def _ssid(self):
+        return None
+
+    def _gateway(self):
+        return None
+
+    def _gateway_mac(self):
+        return None
+
+    def _portal_links(self):
+        return []
+
+    def _interfaces(self):
+        return [{"name": name, "up": None, "wireless": None} for _, name in socket.if_nameindex()]
+
+
+class FakeNetwork(NetworkProvider):
+    # For tests and benchmarks: report whatever was set, bumping the change
+    # key on every set() like a real network change would.
+
+    def __init__(self, ssid=None, gateway=None, interfaces=None, gateway_mac=None, portal_links=None):
+        super().__init__()
+        self.generation = 0
+        self.lookups = 0
+        self.set(ssid, gateway, interfaces, gateway_mac, portal_links)
+
+    def set(self, ssid=None, gateway=None, interfaces=None, gateway_mac=None, portal_links=None):
+        self.values = {"ssid": ssid, "gateway": gateway, "interfaces": interfaces or [],
+                       "gateway_mac": gateway_mac, "portal_links": portal_links or []}
+        self.generation += 1
+
+    def change_key(self):
+        return self.generation
+
+    def _lookup(self, name):
+        self.lookups += 1
+        return self.values[name]
+
+    def _ssid(self):
+        return self._lookup("ssid")
+
+    def _gateway(self):
+        return self._lookup("gateway")
+
+    def _interfaces(self):
+        return self._lookup("interfaces")
+
+    def _gateway_mac(self):
+        return self._lookup("gateway_mac")
+
+    def _portal_links(self):
+        return self._lookup("portal_links")
+
+
+class WindowsNetwork(NetworkProvider):
+    # WlanAPI and iphlpapi through ctypes; netsh only as a fallback
+
+    def _ssid(self):
+        try:
+            return _wlan_connected_ssid()
+        except Exception:
+            return _netsh_ssid()
+
+    def _gateway(self):
+        row = _MIB_IPFORWARDROW()
+        dest = struct.unpack("<I", socket.inet_aton(urllib.parse.urlsplit(PORTAL_BASE).hostname))[0]
+        if ctypes.windll.iphlpapi.GetBestRoute(dest, 0, ctypes.byref(row)) != 0:
+            return None
+        hop = socket.inet_ntoa(struct.pack("<I", row.next_hop))
+        # Next hop == destination means directly connected
+        return (None if row.next_hop == dest else hop), str(row.if_index)
+
+    def _gateway_mac(self):
+        hop = self._next_hop()
+        if hop is None:
+            return None
+        # MIB_IPNETTABLE: entry count, then 24-byte MIB_IPNETROWs
+        iphlpapi = ctypes.windll.iphlpapi
+        size = wintypes.ULONG(0)
+        iphlpapi.GetIpNetTable(None, ctypes.byref(size), False)
+        buf = ctypes.create_string_buffer(size.value)
+        if iphlpapi.GetIpNetTable(buf, ctypes.byref(size), False) != 0:
+            return None
+        raw = buf.raw
+        want = socket.inet_aton(hop)
+        for i in range(struct.unpack_from("<I", raw)[0]):
+            _, length, phys, addr, _ = struct.unpack_from("<II8s4sI", raw, 4 + i * 24)
+            if addr == want and length:
+                return phys[:length].hex(":")
+        return None
+
+    def _portal_links(self):
+        iphlpapi = ctypes.windll.iphlpapi
+
+        def table(fn):
+            size = wintypes.ULONG(0)
+            fn(None, ctypes.byref(size), False)
+            buf = ctypes.create_string_buffer(size.value)
+            return buf.raw if fn(buf, ctypes.byref(size), False) == 0 else b""
+
+        target = struct.unpack("<I", socket.inet_aton(urllib.parse.urlsplit(PORTAL_BASE).hostname))[0]
+        # MIB_IPFORWARDTABLE: entry count, then 56-byte MIB_IPFORWARDROWs
+        routes = table(iphlpapi.GetIpForwardTable)
+        indexes = set()
+        for i in range(struct.unpack_from("<I", routes)[0] if routes else 0):
+            dest, mask, _, _, index = struct.unpack_from("<5I", routes, 4 + i * 56)
+            if target & mask == dest:
+                indexes.add(index)
+        # MIB_IPADDRTABLE: entry count, then 24-byte MIB_IPADDRROWs
+        addresses = table(iphlpapi.GetIpAddrTable)
+        links = []
+        for i in range(struct.unpack_from("<I", addresses)[0] if addresses else 0):
+            addr, index = struct.unpack_from("<4sI", addresses, 4 + i * 24)
+            if index in indexes and addr != b"\0\0\0\0":
+                indexes.discard(index)  # first address only
+                links.append({"name": _ifname(index), "address": socket.inet_ntoa(addr)})
+        return links
+
+
+def _netsh_ssid():
+    try:
+        import subprocess
+        r = subprocess.run(["netsh", "wlan", "show", "interfaces"],
+                           capture_output=True, text=True, timeout=5)
+        for line in r.stdout.splitlines():
+            if line.strip().startswith("SSID") and "BSSID" not in line:
+                return line.split(":", 1)[1].strip()
+    except Exception:
+        pass
+    return None
+
+
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    class _GUID(ctypes.Structure):
+        _fields_ = [("Data1", wintypes.DWORD), ("Data2", wintypes.WORD),
+                    ("Data3", wintypes.WORD), ("Data4", ctypes.c_ubyte * 8)]
+
+    class _WLAN_INTERFACE_INFO(ctypes.Structure):
+        _fields_ = [("InterfaceGuid", _GUID), ("strInterfaceDescription", ctypes.c_wchar * 256),
+                    ("isState", ctypes.c_uint)]
+
+    class _WLAN_INTERFACE_INFO_LIST(ctypes.Structure):
+        _fields_ = [("dwNumberOfItems", wintypes.DWORD), ("dwIndex", wintypes.DWORD),
+                    ("InterfaceInfo", _WLAN_INTERFACE_INFO * 1)]
+
+    class _DOT11_SSID(ctypes.Structure):
+        _fields_ = [("uSSIDLength", wintypes.ULONG), ("ucSSID", ctypes.c_ubyte * 32)]
+
+    class _WLAN_ASSOCIATION_ATTRIBUTES(ctypes.Structure):
+        _fields_ = [("dot11Ssid", _DOT11_SSID), ("dot11BssType", ctypes.c_uint),
+                    ("dot11Bssid", ctypes.c_ubyte * 6), ("dot11PhyType", ctypes.c_uint),
+                    ("uDot11PhyIndex", wintypes.ULONG), ("wlanSignalQuality", wintypes.ULONG),
+                    ("ulRxRate", wintypes.ULONG), ("ulTxRate", wintypes.ULONG)]
+
+    class _WLAN_CONNECTION_ATTRIBUTES(ctypes.Structure):
+        # Trailing security attributes are not needed and left out
+        _fields_ = [("isState", ctypes.c_uint), ("wlanConnectionMode", ctypes.c_uint),
+                    ("strProfileName", ctypes.c_wchar * 256),
+                    ("wlanAssociationAttributes", _WLAN_ASSOCIATION_ATTRIBUTES)]
+
+    class _MIB_IPFORWARDROW(ctypes.Structure):
+        _fields_ = [(name, wintypes.DWORD) for name in (
+            "dest", "mask", "policy", "next_hop", "if_index", "type", "proto", "age",
+            "next_hop_as", "metric1", "metric2", "metric3", "metric4", "metric5")]
+
+    class _CREDENTIAL(ctypes.Structure):
+        _fields_ = [("Flags", wintypes.DWORD), ("Type", wintypes.DWORD), ("TargetName", wintypes.LPWSTR),
+                    ("Comment", wintypes.LPWSTR), ("LastWritten", wintypes.FILETIME),
+                    ("CredentialBlobSize", wintypes.DWORD), ("CredentialBlob", ctypes.POINTER(ctypes.c_ubyte)),
+                    ("Persist", wintypes.DWORD), ("AttributeCount", wintypes.DWORD),
+                    ("Attributes", ctypes.c_void_p), ("TargetAlias", wintypes.LPWSTR),
+                    ("UserName", wintypes.LPWSTR)]
+
+    def _wlan_connected_ssid():
+        wlanapi = ctypes.windll.wlanapi
+        handle = wintypes.HANDLE()
+        version = wintypes.DWORD()
+        if wlanapi.WlanOpenHandle(2, None, ctypes.byref(version), ctypes.byref(handle)) != 0:
+            raise OSError("WlanOpenHandle failed")
+        try:
+            ifaces = ctypes.POINTER(_WLAN_INTERFACE_INFO_LIST)()
+            if wlanapi.WlanEnumInterfaces(handle, None, ctypes.byref(ifaces)) != 0:
+                raise OSError("WlanEnumInterfaces failed")
+            try:
+                count = ifaces.contents.dwNumberOfItems
+                items = ctypes.cast(ctypes.addressof(ifaces.contents.InterfaceInfo),
+                                    ctypes.POINTER(_WLAN_INTERFACE_INFO))
+                for i in range(count):
+                    if items[i].isState != 1:  # wlan_interface_state_connected
+                        continue
+                    size = wintypes.DWORD()
+                    attrs = ctypes.POINTER(_WLAN_CONNECTION_ATTRIBUTES)()
+                    # 7 = wlan_intf_opcode_current_connection
+                    if wlanapi.WlanQueryInterface(handle, ctypes.byref(items[i].InterfaceGuid), 7, None,
+                                                  ctypes.byref(size), ctypes.byref(attrs), None) != 0:
+                        continue
+                    try:
+                        ssid = attrs.contents.wlanAssociationAttributes.dot11Ssid
+                        return bytes(ssid.ucSSID[:ssid.uSSIDLength]).decode("utf-8", errors="replace")
+                    finally:
+                        wlanapi.WlanFreeMemory(attrs)
+            finally:
+                wlanapi.WlanFreeMemory(ifaces)
+        finally:
+            wlanapi.WlanCloseHandle(handle, None)
+        return None
+
+
+# Linux netlink constants (linux/netlink.h, rtnetlink.h, genetlink.h, nl80211.h)
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK, RTM_DELLINK = 16, 17
+RTM_NEWADDR, RTM_DELADDR, RTM_GETADDR = 20, 21, 22
+RTM_NEWROUTE, RTM_DELROUTE = 24, 25
+IFF_LOWER_UP = 0x10000
+IFA_ADDRESS, IFA_LOCAL = 1, 2
+RTA_DST, RTA_OIF, RTA_GATEWAY, RTA_TABLE = 1, 4, 5, 15
+RT_TABLE_MAIN = 254
+RT_SCOPE_HOST = 254
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+NL80211_CMD_GET_INTERFACE = 5
+NL80211_ATTR_IFNAME = 4
+NL80211_ATTR_SSID = 52
+
+
+def _nlattr(kind, data):
+    length = 4 + len(data)
+    return struct.pack("=HH", length, kind) + data + b"\0" * (-length % 4)
+
+
+def _parse_nlattrs(data):
+    attrs = {}
+    pos = 0
+    while pos + 4 <= len(data):
+        length, kind = struct.unpack_from("=HH", data, pos)
+        if length < 4:
+            break
+        attrs[kind & 0x3FFF] = data[pos + 4:pos + length]
+        pos += (length + 3) & ~3
+    return attrs
+
+
+def _netlink_messages(sock):
+    # Yields (type, payload) for each reply until the dump or request is done
+    while True:
+        data = sock.recv(65536)
+        pos = 0
+        while pos + 16 <= len(data):
+            length, kind, flags, _, _ = struct.unpack_from("=IHHII", data, pos)
+            if kind == NLMSG_DONE:
+                return
+            if kind == NLMSG_ERROR:
+                errno = struct.unpack_from("=i", data, pos + 16)[0]
+                if errno:
+                    raise OSError(-errno, "netlink error")
+                return
+            yield kind, data[pos + 16:pos + length]
+            pos += (length + 3) & ~3
+            if not flags & 0x2:  # NLM_F_MULTI
+                return
+
+
+def _genl_request(sock, family, cmd, attrs=b"", flags=NLM_F_REQUEST):
+    payload = struct.pack("=BBH", cmd, 1, 0) + attrs
+    sock.send(struct.pack("=IHHII", 16 + len(payload), family, flags, 1, 0) + payload)
+    return _netlink_messages(sock)
+
+
+class LinuxNetwork(NetworkProvider):
+    # Kernel interfaces only: nl80211 over generic netlink for the SSID,
+    # /proc/net/route for the gateway, /sys/class/net for interfaces, and an
+    # rtnetlink subscription as the change notification. No processes spawned.
+
+    def __init__(self):
+        super().__init__()
+        self.generation = 0
+        try:
+            self._events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self._events.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+            self._events.setblocking(False)
+        except OSError:
+            self._events = None
+
+    def change_key(self):
+        if self._events is None:
+            return network_signature()
+        try:
+            while self._events.recv(65536):
+                self.generation += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # Receive buffer overran: events were lost, so assume a change
+            self.generation += 1
+        return self.generation
+
+    def _ssid(self):
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC) as sock:
+            sock.settimeout(1)
+            family = None
+            for _, payload in _genl_request(sock, GENL_ID_CTRL, CTRL_CMD_GETFAMILY,
+                                            _nlattr(CTRL_ATTR_FAMILY_NAME, b"nl80211\0")):
+                family_id = _parse_nlattrs(payload[4:]).get(CTRL_ATTR_FAMILY_ID)
+                if family_id:
+                    family = struct.unpack("=H", family_id[:2])[0]
+            if family is None:
+                return None
+            ssid = None
+            for _, payload in _genl_request(sock, family, NL80211_CMD_GET_INTERFACE,
+                                            flags=NLM_F_REQUEST | NLM_F_DUMP):
+                value = _parse_nlattrs(payload[4:]).get(NL80211_ATTR_SSID)
+                if value and ssid is None:
+                    ssid = value.decode("utf-8", errors="replace")
+            return ssid
+
+    def _gateway(self):
+        target = struct.unpack("<I", socket.inet_aton(urllib.parse.urlsplit(PORTAL_BASE).hostname))[0]
+        best = None
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                iface, dest, gateway, flags, mask = fields[0], int(fields[1], 16), int(fields[2], 16), \
+                    int(fields[3], 16), int(fields[7], 16)
+                if not flags & 0x1 or target & mask != dest:  # RTF_UP
+                    continue
+                prefix = bin(mask).count("1")
+                if best is None or prefix > best[0]:
+                    hop = socket.inet_ntoa(struct.pack("<I", gateway)) if flags & 0x2 else None  # RTF_GATEWAY
+                    best = (prefix, hop, iface)
+        return best and best[1:]
+
+    def _gateway_mac(self):
+        hop = self._next_hop()
+        with open("/proc/net/arp") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[0] == hop and fields[3] != "00:00:00:00:00:00":
+                    return fields[3]
+        return None
+
+    def _portal_links(self):
+        # Interfaces with any route covering the portal (/proc/net/route),
+        # with their first IPv4 address from an rtnetlink address dump
+        target = struct.unpack("<I", socket.inet_aton(urllib.parse.urlsplit(PORTAL_BASE).hostname))[0]
+        names = set()
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if int(fields[3], 16) & 0x1 and target & int(fields[7], 16) == int(fields[1], 16):
+                    names.add(fields[0])
+        links = {}
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+            sock.settimeout(1)
+            request = struct.pack("=BBBBI", socket.AF_INET, 0, 0, 0, 0)
+            sock.send(struct.pack("=IHHII", 16 + len(request), RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+                      + request)
+            for kind, payload in _netlink_messages(sock):
+                if kind != RTM_NEWADDR or len(payload) < 8:
+                    continue
+                _, _, _, scope, index = struct.unpack_from("=BBBBI", payload)
+                attrs = _parse_nlattrs(payload[8:])
+                address = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+                name = _ifname(index)
+                if name in names and name not in links and address and scope != RT_SCOPE_HOST:
+                    links[name] = socket.inet_ntoa(address[:4])
+        return [{"name": name, "address": links[name]} for name in sorted(links)]
+
+    def _interfaces(self):
+        found = []
+        for name in sorted(os.listdir("/sys/class/net")):
+            base = os.path.join("/sys/class/net", name)
+            try:
+                with open(os.path.join(base, "operstate")) as f:
+                    up = f.read().strip() in ("up", "unknown")
+            except OSError:
+                up = False
+            found.append({"name": name, "up": up, "wireless": os.path.isdir(os.path.join(base, "wireless"))})
+        return found
+
+
+class RouteEvents:
+    # rtnetlink subscription for the daemon on Linux: wait() sleeps until the
+    # kernel reports a change that matters for reaching the portal (a route
+    # covering it, an IPv4 address, a link going up or down) and returns
+    # descriptions of the whole debounced burst.
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self._sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        self._sock.setblocking(False)
+        self._portal = struct.unpack("!I", socket.inet_aton(urllib.parse.urlsplit(PORTAL_BASE).hostname))[0]
+        self._links = {}
+
+    @classmethod
+    def open(cls):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            return cls()
+        except OSError:
+            return None
+
+    def close(self):
+        self._sock.close()
+
+    def wait(self, timeout, also=()):
+        # Returns early, with what it has, once any socket in also is readable
+        changes = []
+        end = time.monotonic() + timeout
+        latest = None
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([self._sock, *also], [], [], remaining)
+            if not ready:
+                break
+            if any(s in ready for s in also):
+                changes += self._read()
+                break
+            found = self._read()
+            if not found:
+                continue
+            if not changes:
+                latest = time.monotonic() + NETLINK_DEBOUNCE_MAX
+            changes += [c for c in found if c not in changes]
+            end = min(latest, time.monotonic() + NETLINK_DEBOUNCE)
+        return changes
+
+    def _read(self):
+        found = []
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                pos = 0
+                while pos + 16 <= len(data):
+                    length, kind = struct.unpack_from("=IH", data, pos)
+                    if length < 16:
+                        break
+                    change = self._describe(kind, data[pos + 16:pos + length])
+                    if change:
+                        found.append(change)
+                    pos += (length + 3) & ~3
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            found.append("events lost")  # receive buffer overran
+        return found
+
+    def _describe(self, kind, payload):
+        if kind in (RTM_NEWLINK, RTM_DELLINK) and len(payload) >= 16:
+            _, _, index, flags, _ = struct.unpack_from("=BxHiII", payload)
+            up = kind == RTM_NEWLINK and bool(flags & IFF_LOWER_UP)
+            if self._links.get(index) == up:
+                return None  # e.g. statistics or wireless updates
+            self._links[index] = up
+            return f"link {_ifname(index)} {'up' if up else 'down'}"
+        if kind in (RTM_NEWADDR, RTM_DELADDR) and len(payload) >= 8:
+            family, prefix, _, scope, index = struct.unpack_from("=BBBBI", payload)
+            attrs = _parse_nlattrs(payload[8:])
+            address = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            if family != socket.AF_INET or scope == RT_SCOPE_HOST or not address:
+                return None
+            verb = "added" if kind == RTM_NEWADDR else "removed"
+            return f"address {socket.inet_ntoa(address[:4])}/{prefix} on {_ifname(index)} {verb}"
+        if kind in (RTM_NEWROUTE, RTM_DELROUTE) and len(payload) >= 12:
+            family, dst_len, _, _, table = struct.unpack_from("=BBBBB", payload)
+            attrs = _parse_nlattrs(payload[12:])
+            if RTA_TABLE in attrs:
+                table = struct.unpack("=I", attrs[RTA_TABLE][:4])[0]
+            if family != socket.AF_INET or table != RT_TABLE_MAIN:
+                return None
+            dst = struct.unpack("!I", attrs[RTA_DST][:4])[0] if RTA_DST in attrs else 0
+            mask = (0xFFFFFFFF << (32 - dst_len)) & 0xFFFFFFFF
+            if self._portal & mask != dst:
+                return None  # doesn't lead to the portal
+            via = f" via {socket.inet_ntoa(attrs[RTA_GATEWAY][:4])}" if RTA_GATEWAY in attrs else ""
+            dev = f" dev {_ifname(struct.unpack('=I', attrs[RTA_OIF][:4])[0])}" if RTA_OIF in attrs else ""
+            verb = "added" if kind == RTM_NEWROUTE else "removed"
+            return f"route {socket.inet_ntoa(struct.pack('!I', dst))}/{dst_len}{via}{dev} {verb}"
+        return None
+
+
+def _ifname(index):
+    try:
+        return socket.if_indextoname(index)
+    except OSError:
+        return f"#{index}"
+
+
+def make_network_provider():
+    if os.name == "nt":
+        return WindowsNetwork()
+    if sys.platform.startswith("linux"):
+        return LinuxNetwork()
+    return NetworkProvider()
+
+
+_network = None
+_active_portal = None
+
+
+def get_network():
+    global _network
+    if _network is None:
+        _network = make_network_provider()
+    return _network
+
+
+def get_wifi_ssid():
+    return get_network().ssid()
+
+
+def _describe_route(route):
+    if not route:
+        return "unknown"
+    gateway, iface = route
+    return f"via {gateway} ({iface})" if gateway else f"direct ({iface})"
+
+
+_resolved = {}  # host -> (address, expires), verified answers only
+
+
+def probe_addresses(host):
+    # Where to send a probe for host without asking DNS: a verified answer
+    # still in the cache, then the pinned addresses
+    cached = _resolved.get(host)
+    addresses = [cached[0]] if cached and cached[1] > time.monotonic() else []
+    return addresses + [a for a in PINNED_ADDRESSES.get(host, []) if a not in addresses]
+
+
+def resolve(host):
+    infos = socket.getaddrinfo(host.encode("ascii") if host.isascii() else host, 80,
+                               socket.AF_INET, socket.SOCK_STREAM)
+    return infos[0][4][0]
+
+
+def internet_is_working(pool=HTTP, timeout=PROBE_TIMEOUT):
+    # One probe, preferring a host that needs no DNS
+    probe = min(CONNECTIVITY_PROBES, key=lambda p: not probe_addresses(urllib.parse.urlsplit(p[0]).hostname))
+    return connectivity_probe(*probe, pool=pool, timeout=timeout)[0] is True
+
+
+def connectivity_probe(url, expect_status, expect_text, pool=HTTP, timeout=PROBE_TIMEOUT):
+    # Returns (result, portal): result is True = online, False = answered but
+    # intercepted (captive), None = no answer. When intercepted, portal is the
+    # origin the captive redirect points at, if any. Cached and pinned
+    # addresses are tried before DNS.
+    host = urllib.parse.urlsplit(url).hostname
+    candidates = probe_addresses(host)
+    looked_up = False
+    while True:
+        if not candidates:
+            if looked_up:
+                return None, None
+            looked_up = True
+            try:
+                candidates = [resolve(host)]
+            except OSError:
+                return None, None
+        address = candidates.pop(0)
+        try:
+            status, headers, body = pool.request("GET", url, timeout=timeout, address=address)
+            break
+        except Exception:
+            continue
+    text = body.decode("utf-8", errors="ignore")
+    if status == expect_status and expect_text in text:
+        _resolved[host] = (address, time.monotonic() + RESOLVE_TTL)
+        return True, None
+    return False, portal_from_response(url, status, headers, text)
+
+
+def portal_from_response(probe_url, status, headers, text):
+    # Captive portals answer probes with a redirect (Location header) or a
+    # page with a meta refresh; either one names the portal
+    target = None
+    if 300 <= status < 400:
+        target = headers.get("location")
+    else:
+        match = META_REFRESH.search(text)
+        if match:
+            import html
+            target = html.unescape(match.group(1))
+    if not target:
+        return None
+    parts = urllib.parse.urlsplit(urllib.parse.urljoin(probe_url, target))
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return None
+    if parts.netloc == urllib.parse.urlsplit(probe_url).netloc:
+        return None
+    if parts.port != SOPHOS_PORT and not parts.path.endswith(SOPHOS_PAGE):
+        return None  # some other captive portal (hotel, cafe)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def portal_base():
+    return _active_portal or PORTAL_BASE
+
+
+def set_active_portal(base):
+    global _active_portal
+    _active_portal = base
+
+
+def network_fingerprint():
+    # Identifies the network rather than our address on it: SSID, next hop
+    # towards the portal (IP and MAC) and the /24 we're on. A new DHCP lease
+    # keeps it; home, cafe and campus all differ.
+    net = get_network()
+    route = net.gateway()
+    source = network_signature()
+    subnet = source.rsplit(".", 1)[0] + ".0/24" if source else "-"
+    hop = (route[0] or "direct") if route else "-"
+    return "|".join([net.ssid() or "-", hop, net.gateway_mac() or "-", subnet])
+
+
+def load_networks():
+    try:
+        with open(NETWORKS_FILE, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def known_network(key):
+    return load_networks().get(key)
+
+
+def record_network(key, **fields):
+    # Update one network's entry and mark it most recently used. The file
+    # keeps entries in use order, so eviction drops from the front.
+    db = load_networks()
+    entry = db.pop(key, {"first_seen": round(time.time())})
+    entry.update(fields)
+    entry["seen"] = round(time.time())
+    db[key] = entry
+    for old in list(db)[:-NETWORK_DB_SIZE]:
+        del db[old]
+    tmp = NETWORKS_FILE + ".tmp"
     try:
-        r = subprocess.run(["netsh", "wlan", "show", "interfaces"],
-                           capture_output=True, text=True, timeout=5)
-        for line in r.stdout.splitlines():
-            if line.strip().startswith("SSID") and "BSSID" not in line:
-                return line.split(":", 1)[1].strip()
-    except Exception:
+        with open(tmp, "w") as f:
+            json.dump(db, f, indent=1)
+        os.replace(tmp, NETWORKS_FILE)
+    except OSError:
         pass
+
+
+def portal_absent(entry, cfg):
+    # True while a "no portal here" verdict for this network is still trusted
+    if not entry or entry.get("portal") is not False or get_wifi_ssid() == TARGET_SSID:
+        return False
+    return time.time() - entry.get("checked", 0) < cfg.get("negative_cache_seconds", NETWORK_NEGATIVE_TTL)
+
+
+def cached_portal(entry):
+    if entry and entry.get("base") and entry.get("verified") and entry.get("base_until", 0) > time.time():
+        return entry["base"]
     return None
 
 
-def internet_is_working():
+def remember_portal(base):
+    now = time.time()
+    record_network(network_fingerprint(), portal=True, misses=0, checked=round(now), base=base, verified=True,
+                   base_until=round(now + PORTAL_CACHE_TTL))
+
+
+def trusted_portal(base):
+    # A portal found from a redirect gets the credentials only on the NUJS
+    # network (its SSID, or a network already known to have the portal) and
+    # only if it answers a request without credentials like Sophos does
+    if get_wifi_ssid() != TARGET_SSID and not (known_network(network_fingerprint()) or {}).get("portal"):
+        return False
+    query = urllib.parse.urlencode({"mode": "192", "username": "", "producttype": "0"})
     try:
-        resp = urllib.request.urlopen("http://captive.apple.com/hotspot-detect.html", timeout=5)
-        return "Success" in resp.read().decode("utf-8", errors="ignore")
+        _, _, body = HTTP.request("GET", f"{base}{LIVE_PATH}?{query}", timeout=3)
     except Exception:
         return False
+    return b"<requestresponse>" in body
+
+
+def print_networks():
+    db = load_networks()
+    if not db:
+        print("[*] No networks recorded yet.")
+        return
+    print(f"{'last seen':<18}{'portal':<8}{'login ms':>9}{'hedge ms':>9}  network (ssid|next hop|mac|subnet)")
+    for key, entry in reversed(list(db.items())):
+        seen = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.get("seen", 0)))
+        portal = {True: "yes", False: "no"}.get(entry.get("portal"), "?")
+        login_ms = f"{entry['login_ms']:.0f}" if "login_ms" in entry else "-"
+        hedge_ms = f"{login_timing(entry)[0] * 1000:.0f}" if entry.get("login_samples") else "-"
+        print(f"{seen:<18}{portal:<8}{login_ms:>9}{hedge_ms:>9}  {key}")
+
+
+def record_portal_miss(key, entry):
+    # The portal didn't answer on this network. Only NETWORK_NEGATIVE_MISSES
+    # visits in a row like that (never on TARGET_SSID, never on a network
+    # seen with the portal) make it "no portal here"; until then it stays
+    # unknown. Returns whether it is now cached as having no portal.
+    entry = entry or {}
+    misses = entry.get("misses", 0) + 1
+    absent = misses >= NETWORK_NEGATIVE_MISSES and not entry.get("portal") and get_wifi_ssid() != TARGET_SSID
+    record_network(key, portal=False if absent else None, misses=misses, checked=round(time.time()))
+    return absent
+
+
+def learn_network(key, entry, portal_seen):
+    # A visit to a network that already has internet and isn't known yet: is
+    # the portal here (campus, already logged in) or not (home, cafe)?
+    if portal_seen or portal_accepts_tcp(NETWORK_LEARN_TIMEOUT):
+        record_network(key, portal=True, misses=0, checked=round(time.time()))
+        log(f"[*] New network with the NUJS portal: {key}")
+    elif record_portal_miss(key, entry):
+        log(f"[*] Network without the NUJS portal: {key}")
 
 
 def portal_is_reachable():
     try:
-        urllib.request.urlopen(PORTAL_BASE, timeout=3)
-        return True
+        status, _, _ = HTTP.request("GET", portal_base(), timeout=3)
+        return status < 400
     except Exception:
         return False
 
 
-def sophos_login(username, password):
+def portal_accepts_tcp(timeout, source=None):
+    url = urllib.parse.urlsplit(portal_base())
+    return tcp_connects((url.hostname, url.port or (443 if url.scheme == "https" else 80)), timeout, source)
+
+
+def tcp_connects(address, timeout, source=None):
+    try:
+        with socket.create_connection(address, timeout, (source, 0) if source else None):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_portal(deadline=PORTAL_WAIT_DEADLINE, source=None):
+    # Returns (seconds until the portal accepted a connection or None, attempts).
+    # With source, the probes go out from that local address.
+    start = time.monotonic()
+    end = start + deadline
+    delay = PORTAL_WAIT_FIRST
+    attempts = 0
+    while time.monotonic() < end:
+        attempts += 1
+        tried = time.monotonic()
+        up = portal_accepts_tcp(min(1.0, max(end - time.monotonic(), 0.01)), source)
+        trace("tcp", ok=up, ms=_ms_since(tried))
+        if up:
+            return time.monotonic() - start, attempts
+        pause = delay / 2 + random.uniform(0, delay / 2)
+        time.sleep(max(0, min(pause, end - time.monotonic())))
+        delay = min(delay * 2, PORTAL_WAIT_MAX)
+    return None, attempts
+
+
+def _run_probe(results, name, fn, args):
+    started = time.monotonic()
+    try:
+        result = fn(*args)
+    except Exception:
+        result = None
+    trace("probe", target=name, ok=result[0] if isinstance(result, tuple) else result, ms=_ms_since(started))
+    results.put((name, result))
+
+
+def probe_network(timeout=PROBE_TIMEOUT):
+    # Race the portal probe against every connectivity probe and decide from the
+    # first conclusive answers. Returns (verdict, portal_up, seconds); verdict is
+    # "online", "captive" or "offline". Probes still in flight are abandoned.
+    # A captive redirect to a different portal switches portal_base() to it.
+    start = time.monotonic()
+    probed_base = portal_base()
+    results = queue.Queue()
+    jobs = [("portal", portal_is_reachable, ())]
+    jobs += [("internet", connectivity_probe, p) for p in CONNECTIVITY_PROBES]
+    for name, fn, args in jobs:
+        threading.Thread(target=_run_probe, args=(results, name, fn, args), daemon=True).start()
+
+    deadline = start + timeout
+    pending = len(CONNECTIVITY_PROBES)
+    portal_up = None
+    intercepted = False
+    discovered = None
+    verdict = None
+    for _ in jobs:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            name, result = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if name == "portal":
+            portal_up = result
+        else:
+            pending -= 1
+            ok, found = result or (None, None)
+            if ok:
+                verdict = "online"
+                break
+            if ok is False:
+                intercepted = True
+                discovered = discovered or found
+        if intercepted and discovered and discovered != probed_base:
+            # Redirected somewhere else: the configured portal's answer is moot
+            verdict = "captive"
+            portal_up = False
+            break
+        if portal_up and (intercepted or pending == 0):
+            verdict = "captive"
+            break
+        if portal_up is False and pending == 0:
+            break
+
+    if discovered and discovered != probed_base:
+        if trusted_portal(discovered):
+            log(f"[*] Captive redirect points at portal {discovered} (was {probed_base})")
+            set_active_portal(discovered)
+            remember_portal(discovered)
+        else:
+            log(f"[*] Captive redirect to {discovered} ignored: not a NUJS portal on this network")
+    if verdict is None:
+        verdict = "captive" if portal_up else "offline"
+    trace("race", verdict=verdict, portal=bool(portal_up), ms=_ms_since(start))
+    return verdict, bool(portal_up), time.monotonic() - start
+
+
+def sophos_login(username, password, pool=HTTP, timeout=LOGIN_TIMEOUT):
     params = urllib.parse.urlencode({
         "mode": "191",
         "username": username,
@@ -76,67 +2007,1296 @@ def sophos_login(username, password):
         "producttype": "0",
     }).encode("utf-8")
 
-    req = urllib.request.Request(
-        f"{PORTAL_BASE}/login.xml",
-        data=params,
-        method="POST",
+    _, _, body = pool.request(
+        "POST",
+        portal_base() + LOGIN_PATH,
+        body=params,
         headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=timeout,
     )
-    resp = urllib.request.urlopen(req, timeout=10)
-    body = resp.read().decode("utf-8", errors="ignore")
-    root = ElementTree.fromstring(body)
-    status = root.findtext("status", "").strip()
-    message = root.findtext("message", "").strip()
-    return status, message
+    reply = _portal_reply(body)
+    return _xml_text(reply, "status"), _xml_text(reply, "message")
 
 
-def main():
+def _portal_reply(body):
+    text = body.decode("utf-8", errors="ignore")
+    if "<requestresponse" not in text:
+        raise ValueError(f"not a portal reply: {text[:60]!r}")
+    return text
+
+
+def _xml_text(text, tag):
+    # Text of the first <tag> (CDATA or plain) in a portal reply. The replies
+    # are tiny and fixed-shape, so this skips importing an XML parser.
+    match = re.search(XML_FIELD.format(tag), text, re.S)
+    if not match:
+        return ""
+    if match.group(1) is not None:
+        return match.group(1).strip()
+    import html
+    return html.unescape(match.group(2)).strip()
+
+
+def classify_response(status, message):
+    if status == "LIVE":
+        return PortalState.LIVE
+    text = message.lower()
+    for fragment, state in PORTAL_MESSAGES:
+        if fragment in text:
+            return state
+    return PortalState.TRANSIENT
+
+
+def login_timing(entry):
+    # (hedge after, timeout) in seconds for login POSTs on a network
+    samples = sorted((entry or {}).get("login_samples", []))
+    if len(samples) < LOGIN_MIN_SAMPLES:
+        return LOGIN_HEDGE_AFTER, LOGIN_TIMEOUT
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] / 1000
+    hedge_after = max(LOGIN_HEDGE_MIN, p95)
+    timeout = min(LOGIN_TIMEOUT, max(LOGIN_TIMEOUT_MIN, 3 * samples[-1] / 1000, 2 * hedge_after))
+    return hedge_after, timeout
+
+
+def _timed_login(results, pool, username, password, timeout, own_pool=False):
+    # own_pool: a pool made for this request alone, closed once it's answered
+    started = time.monotonic()
+    try:
+        results.put((sophos_login(username, password, pool, timeout), None, _ms_since(started)))
+    except Exception as e:
+        results.put((None, e, _ms_since(started)))
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def hedged_login(username, password, hedge_after=LOGIN_HEDGE_AFTER, timeout=LOGIN_TIMEOUT, samples=None,
+                 pool=HTTP):
+    # One login POST, plus a second on a fresh connection if the first hasn't
+    # answered within hedge_after seconds. Returns the first successful
+    # (status, message). Both POSTs carry the same credentials and the portal
+    # answers a repeat with "already logged in", so the slower one is harmless
+    # and its reply is dropped; a refusal is only returned once neither can
+    # still succeed. Reply times (ms) are appended to samples.
+    results = queue.Queue()
+    threading.Thread(target=_timed_login, args=(results, pool, username, password, timeout),
+                     daemon=True).start()
+    started = time.monotonic()
+    pending, hedged = 1, False
+    refusal = error = None
+    while pending:
+        if hedged:
+            wait = started + hedge_after + timeout - time.monotonic()
+        else:
+            wait = started + hedge_after - time.monotonic()
+        try:
+            reply, exc, ms = results.get(timeout=max(0, wait))
+        except queue.Empty:
+            if hedged:
+                break
+            log(f"[*] No login reply after {hedge_after * 1000:.0f} ms - sending a second request")
+            trace("hedge", after=round(hedge_after * 1000, 1))
+            threading.Thread(target=_timed_login, args=(results, HTTPPool(pool.source), username, password,
+                                                        timeout, True), daemon=True).start()
+            pending, hedged = pending + 1, True
+            continue
+        pending -= 1
+        if exc is not None:
+            error = error or exc
+            continue
+        if samples is not None:
+            samples.append(ms)
+        if classify_response(*reply) in SUCCESS_STATES:
+            return reply
+        refusal = refusal or reply
+    if refusal:
+        return refusal
+    raise error or socket.timeout(f"no login reply within {timeout:.1f}s")
+
+
+def login(username, password, budget=LOGIN_RETRY_BUDGET, timing=(LOGIN_HEDGE_AFTER, LOGIN_TIMEOUT),
+          samples=None, pool=HTTP):
+    # Drive the login POST until it reaches a non-transient state or the retry
+    # budget runs out. timing is login_timing()'s (hedge after, timeout).
+    # Returns (PortalState, message).
+    delay = LOGIN_RETRY_DELAY
+    for attempt in range(1, budget + 1):
+        started = time.monotonic()
+        try:
+            status, message = hedged_login(username, password, *timing, samples, pool)
+            state = classify_response(status, message)
+        except Exception as e:
+            state, message = PortalState.TRANSIENT, str(e)
+        trace("login", state=state.name, ms=_ms_since(started))
+        log(f"[*] Portal response: {state.value} ({message})")
+        if state is not PortalState.TRANSIENT or attempt == budget:
+            return state, message
+        pause = delay * random.uniform(0.8, 1.2)
+        log(f"[*] Retrying login in {pause:.1f}s (attempt {attempt + 1}/{budget})")
+        time.sleep(pause)
+        delay *= 2
+
+
+def _credential_id(username, password):
+    import hashlib
+    return hashlib.sha256(f"{username}\0{password}".encode("utf-8")).hexdigest()[:16]
+
+
+def backoff_active(username, password):
+    # Returns the saved terminal state if we must not try these credentials yet
+    try:
+        with open(BACKOFF_FILE, "r") as f:
+            saved = json.load(f)
+    except Exception:
+        return None
+    if saved.get("credentials") != _credential_id(username, password):
+        return None
+    if time.time() >= saved.get("until", 0):
+        return None
+    return saved
+
+
+def save_backoff(username, password, state):
+    saved = {
+        "state": state.value,
+        "credentials": _credential_id(username, password),
+        "until": time.time() + TERMINAL_BACKOFF[state],
+    }
+    try:
+        with open(BACKOFF_FILE, "w") as f:
+            json.dump(saved, f)
+    except Exception:
+        pass
+
+
+def clear_backoff():
+    try:
+        os.remove(BACKOFF_FILE)
+    except OSError:
+        pass
+
+
+def load_state():
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def update_state(**fields):
+    state = load_state()
+    state.update(fields)
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, STATE_FILE)
+    except Exception:
+        pass
+
+
+def save_state(verdict, fingerprint, cfg, logged_in=False):
+    fields = {
+        "verdict": verdict,
+        "fingerprint": fingerprint,
+        "checked_at": time.time(),
+        "session_ttl": cfg.get("session_timeout", SESSION_TIMEOUT),
+    }
+    if logged_in:
+        fields["login_at"] = fields["checked_at"]
+    update_state(**fields)
+
+
+def state_is_fresh(state, fingerprint, cfg):
+    # Returns why the cached verdict can't be trusted, or None if it can
+    if state.get("verdict") not in ("online", "login"):
+        return "no good verdict cached"
+    if fingerprint is None or state.get("fingerprint") != fingerprint:
+        return "network changed"
+    age = time.time() - state.get("checked_at", 0)
+    if age < 0:
+        return "clock went backwards"
+    if age > cfg.get("state_fresh_seconds", STATE_FRESH):
+        return "verdict too old"
+    # A verdict from our own login lasts as long as the session could. One
+    # from a probe that found us online is fresh as of that probe.
+    if (state["verdict"] == "login" and "login_at" in state
+            and time.time() - state["login_at"] > state.get("session_ttl", SESSION_TIMEOUT)):
+        return "session TTL elapsed"
+    return None
+
+
+def sophos_keepalive(username, pool=HTTP):
+    # Sophos "live" request (mode 192). The portal acks a live session and
+    # answers anything else (e.g. "login_again") once the session is gone.
+    query = urllib.parse.urlencode({
+        "mode": "192",
+        "username": username,
+        "a": str(int(time.time() * 1000)),
+        "producttype": "0",
+    })
+    _, _, body = pool.request("GET", f"{portal_base()}{LIVE_PATH}?{query}", timeout=10)
+    return _xml_text(_portal_reply(body), "ack") == "ack"
+
+
+def keepalive_delay(cfg):
+    timeout = cfg.get("session_timeout", SESSION_TIMEOUT)
+    return timeout / 2 * random.uniform(1 - KEEPALIVE_JITTER, 1 + KEEPALIVE_JITTER)
+
+
+def send_keepalive(cfg):
+    # Returns when the next keepalive is due (time.monotonic()), or None if
+    # the portal rejected it and a full login is needed
+    started = time.monotonic()
+    try:
+        ok = sophos_keepalive(cfg.get("username", ""))
+    except Exception as e:
+        event("keepalive", ok=None, ms=_ms_since(started))
+        trace("live", ok=None, ms=_ms_since(started))
+        log(f"[*] Keepalive request failed: {e}")
+        return time.monotonic() + KEEPALIVE_RETRY
+    event("keepalive", ok=ok, ms=_ms_since(started))
+    trace("live", ok=ok, ms=_ms_since(started))
+    if not ok:
+        log("[*] Keepalive rejected by portal.")
+        return None
+    dropped = keepalive_links(cfg.get("username", ""))
+    if dropped:
+        log(f"[*] Keepalive rejected by portal on {', '.join(dropped)}.")
+        return None
+    return time.monotonic() + keepalive_delay(cfg)
+
+
+def health_target():
+    # A probe host reachable without DNS (pinned or verified), on HEALTH_PORT
+    for url, _, _ in CONNECTIVITY_PROBES:
+        addresses = probe_addresses(urllib.parse.urlsplit(url).hostname)
+        if addresses:
+            return addresses[0], HEALTH_PORT
+    return None
+
+
+class SessionMonitor:
+    # Notices a dropped portal session (idle timeout, admin kick, roaming)
+    # within seconds rather than at the next keepalive or periodic check.
+    # One per network: the daemon starts a new one when the network changes.
+
+    def __init__(self):
+        self.target = None
+        self.due = None
+        self.interval = HEALTH_MIN
+        self.passed_at = None
+        self.checks = 0
+        self.false_alarms = 0
+        self.unusable = None  # a target that kept failing while the internet worked
+
+    def start(self, cfg):
+        self.target = health_target() if cfg.get("health_monitor", True) else None
+        if self.target is None or self.target == self.unusable:
+            self.due = None
+            return
+        self.interval = HEALTH_MIN
+        self.passed_at = time.monotonic()
+        self.due = self.passed_at + self.interval
+        self.checks = 0
+        self.false_alarms = 0
+
+    def stop(self):
+        self.due = None
+
+    def check(self):
+        # Returns False once a drop is confirmed (monitoring stops until the
+        # next start()), True otherwise
+        started = time.monotonic()
+        ok = tcp_connects(self.target, HEALTH_TIMEOUT)
+        self.checks += 1
+        observe("health", _ms_since(started), ok)
+        trace("health", ok=ok, ms=_ms_since(started))
+        if not ok:
+            if not internet_is_working():
+                # Somewhere between the last good check and now
+                detected = _ms_since(self.passed_at)
+                observe("drop_detect", detected)
+                event("health", ok=False, target=self.target[0], checks=self.checks, detect_ms=detected)
+                log(f"[*] Session dropped: noticed within {detected / 1000:.1f}s "
+                    f"({self.checks} checks since login)")
+                self.due = None
+                return False
+            self.false_alarms += 1
+            if self.false_alarms >= HEALTH_FALSE_ALARMS:
+                log(f"[*] {self.target[0]}:{self.target[1]} unreachable while the internet works - "
+                    "session health checks off on this network")
+                self.unusable = self.target
+                self.due = None
+                return True
+            if self.false_alarms == 1:
+                log("[*] Health check failed but the internet works - backing off")
+            self.interval = min(self.interval * 2, HEALTH_MAX)
+        else:
+            self.false_alarms = 0
+            self.interval = min(self.interval * HEALTH_BACKOFF, HEALTH_MAX)
+        self.passed_at = time.monotonic()
+        self.due = self.passed_at + self.interval
+        return True
+
+
+# ---- Other interfaces ----
+# A machine on Ethernet and Wi-Fi at once reaches the portal through both, and
+# the portal keeps a session per client address. The default route's
+# interface goes through run_once()'s usual path; every other interface with
+# a route to the portal is probed and logged in alongside it, each with its
+# sockets bound to that interface's address.
+
+link_sessions = {}  # interface name -> {"address", "state", "at"}
+_link_pools = {}  # source address -> HTTPPool, kept for the daemon's lifetime
+
+
+def link_pool(address):
+    if address not in _link_pools:
+        _link_pools[address] = HTTPPool(address)
+    return _link_pools[address]
+
+
+def drop_connections(keep=None):
+    # Closes pooled keep-alive sockets: after a network change or a sleep
+    # they are bound to an address we no longer have, or to a NAT entry the
+    # network has forgotten, and a request on one just sits out its timeout.
+    # With keep (link addresses whose pools are still good), only the link
+    # pools of vanished interfaces go.
+    if keep is None:
+        HTTP.close()
+        keep = ()
+    for address in [a for a in _link_pools if a not in keep]:
+        _link_pools.pop(address).close()
+
+
+def other_links(cfg):
+    # Interfaces besides the default route's that have a route to the portal
+    if not cfg.get("all_interfaces", True):
+        return []
+    primary = network_signature()
+    return [link for link in get_network().portal_links() if link["address"] != primary]
+
+
+def _run_link(results, link, username, password, timing):
+    started = time.monotonic()
+    address = link["address"]
+    pool = link_pool(address)
+    try:
+        waited, _ = wait_for_portal(LINK_PORTAL_WAIT, source=address)
+        if waited is None:
+            state = "no portal"
+        elif internet_is_working(pool):
+            state = "online"
+        else:
+            result, _ = login(username, password, timing=timing, pool=pool)
+            state = "logged in" if result in SUCCESS_STATES else result.value
+    except Exception as e:
+        state = f"failed ({e})"
+    results.put((link["name"], {"address": address, "state": state, "at": round(time.time(), 3)},
+                 _ms_since(started)))
+
+
+def start_link_logins(cfg, username, password, timing):
+    # Probe and log in every other interface at once, in the background.
+    # Hand the result to finish_link_logins().
+    previous = load_state().get("links", {})
+    links, skipped = [], {}
+    for link in other_links(cfg):
+        last = previous.get(link["name"])
+        if (last and last["address"] == link["address"] and last["state"] == "no portal"
+                and 0 <= time.time() - last["at"] < LINK_RETRY):
+            skipped[link["name"]] = last
+        else:
+            links.append(link)
+    results = queue.Queue()
+    for link in links:
+        threading.Thread(target=_run_link, args=(results, link, username, password, timing),
+                         daemon=True).start()
+    return links, skipped, results
+
+
+def finish_link_logins(pending):
+    # Waits for start_link_logins()'s interfaces, then records their sessions
+    # in link_sessions and state.json. True if any of them logged in.
+    links, skipped, results = pending
+    link_sessions.clear()
+    link_sessions.update(skipped)
+    for _ in links:
+        name, session, ms = results.get()
+        link_sessions[name] = session
+        event("link", ok=session["state"] in ("logged in", "online"), link=name, address=session["address"],
+              state=session["state"], ms=ms)
+        trace("link", link=name, state=session["state"], ms=ms)
+        log(f"[*] Interface {name} ({session['address']}): {session['state']} after {ms:.0f} ms")
+    update_state(links=link_sessions)
+    return any(s["state"] == "logged in" for s in link_sessions.values())
+
+
+def _keepalive_link(results, name, session, username):
+    started = time.monotonic()
+    try:
+        ok = sophos_keepalive(username, link_pool(session["address"]))
+    except Exception:
+        ok = None
+    results.put((name, ok, _ms_since(started)))
+
+
+def keepalive_links(username):
+    # Keepalives for the other logged-in interfaces, all at once. Returns the
+    # names of those whose session the portal dropped.
+    live = {name: s for name, s in link_sessions.items() if s["state"] == "logged in"}
+    results = queue.Queue()
+    for name, session in live.items():
+        threading.Thread(target=_keepalive_link, args=(results, name, session, username), daemon=True).start()
+    dropped = []
+    for _ in live:
+        name, ok, ms = results.get()
+        event("keepalive", ok=ok, link=name, ms=ms)
+        if ok is False:
+            link_sessions[name]["state"] = "session dropped"
+            dropped.append(name)
+    return dropped
+
+
+def login_password(cfg):
+    # The password, fetched only once a run is about to send a login POST (off
+    # campus or already online, the credential store is never touched).
+    # Straight from memory after the first run of a daemon. Returns None if
+    # there is none, or the portal refused these credentials recently.
+    username = cfg.get("username", "")
+    started = time.monotonic()
+    password = get_password(cfg)
+    have_credentials = bool(username and password)
+    event("credentials", ok=have_credentials, ms=_ms_since(started))
+    if not have_credentials:
+        log("[*] No credentials found. Run setup (or `set-password`) first.")
+        return None
+    # Don't knock on the portal again with credentials it has refused
+    backoff = backoff_active(username, password)
+    if backoff:
+        until = time.strftime("%Y-%m-%d %H:%M", time.localtime(backoff["until"]))
+        log(f"[*] Portal said '{backoff['state']}' last time. Not retrying until {until}.")
+        return None
+    return password
+
+
+def run_once(cfg, use_cache=True):
+    # Returns the outcome: "login", "online", "off-campus", "failed" (a login
+    # or the portal wait on the campus SSID failed) or "skipped" (no
+    # credentials, or backing off after a refusal)
+    username = cfg.get("username", "")
+
+    # Redundant triggers (logon + network connect + wake) land within seconds
+    # of each other; trust a fresh verdict for the same network
+    fingerprint = network_signature()
+    if use_cache and state_is_fresh(load_state(), fingerprint, cfg) is None:
+        log("[*] Checked moments ago on this network - internet working. Nothing to do.")
+        return "online"
+
     # Check SSID
+    started = time.monotonic()
     ssid = get_wifi_ssid()
-    log(f"[*] Current WiFi: {ssid or '(none)'}")
+    route = get_network().gateway()
+    event("ssid", ok=True, ssid=ssid, ms=_ms_since(started))
+    log(f"[*] Current WiFi: {ssid or '(none)'}, route to portal: {_describe_route(route)}")
 
     if ssid and ssid != TARGET_SSID:
         log("[*] Not on NUJS-CAMPUS WiFi. Nothing to do.")
-        return
+        return "off-campus"
+
+    # What earlier visits taught us about this network
+    net_key = network_fingerprint()
+    known = known_network(net_key)
+    if portal_absent(known, cfg):
+        hours = (time.time() - known["checked"]) / 3600
+        log(f"[*] Known network without the NUJS portal (checked {hours:.1f}h ago). Nothing to do.")
+        record_network(net_key)
+        return "off-campus"
+    # Use the portal this network redirected us to last time, if any
+    set_active_portal(cached_portal(known))
 
-    # Check internet
-    if internet_is_working():
+    if known and known.get("portal"):
+        # Known campus network: no need to ask whether the portal is here,
+        # only whether our session still works
+        started = time.monotonic()
+        online = internet_is_working(timeout=ONLINE_CHECK_TIMEOUT)
+        event("probe", ok=True, verdict="online" if online else "captive", portal=True, ms=_ms_since(started))
+        if online:
+            verdict, portal_ready = "online", True
+        else:
+            log("[*] Known NUJS network - going straight to login.")
+            verdict, portal_ready = "captive", False
+    else:
+        # Check internet and portal together
+        verdict, portal_ready, elapsed = probe_network()
+        event("probe", ok=verdict != "offline", verdict=verdict, portal=portal_ready,
+              ms=round(elapsed * 1000, 1))
+        log(f"[*] Probe verdict: {verdict} in {elapsed * 1000:.0f} ms")
+    if verdict == "online":
         log("[*] Internet already working. No login needed.")
-        return
+        save_state("online", fingerprint, cfg)
+        if known is None or known.get("portal") is None:
+            learn_network(net_key, known, portal_ready)
+        if portal_ready and other_links(cfg):
+            # The portal is here, so the other interfaces may still need it
+            password = login_password(cfg)
+            if password and finish_link_logins(start_link_logins(cfg, username, password, login_timing(known))):
+                return "login"
+        return "online"
+    save_state(verdict, fingerprint, cfg)
 
     # Wait for portal (network may still be initializing)
-    portal_ready = False
-    for attempt in range(1, 11):
-        if portal_is_reachable():
-            portal_ready = True
-            break
-        log(f"[*] Waiting for portal... attempt {attempt}/10")
-        time.sleep(3)
-
     if not portal_ready:
-        log("[*] Portal not reachable after 30s. Not on NUJS network.")
-        return
+        deadline = cfg.get("portal_wait_deadline", PORTAL_WAIT_DEADLINE)
+        log(f"[*] Waiting for portal (up to {deadline}s)...")
+        waited, attempts = wait_for_portal(deadline)
+        event("portal_wait", ok=waited is not None, attempts=attempts,
+              ms=round((waited if waited is not None else deadline) * 1000, 1))
+        if waited is None:
+            log(f"[*] Portal not reachable after {deadline}s ({attempts} probes). Not on NUJS network.")
+            record_portal_miss(net_key, known)
+            return "failed" if ssid == TARGET_SSID else "off-campus"
+        log(f"[*] Portal came up after {waited:.2f}s ({attempts} probes)")
 
     log("[*] Internet down, portal reachable - logging in...")
+    record_network(net_key, portal=True, misses=0, checked=round(time.time()))
 
-    # Load credentials
-    cfg = load_config()
-    username = cfg.get("username", "")
-    password = cfg.get("password", "")
+    password = login_password(cfg)
+    if not password:
+        return "skipped"
 
-    if not username or not password:
-        log("[*] No credentials found in config.json. Run setup first.")
-        return
+    started = time.monotonic()
+    samples = []
+    timing = login_timing(known)
+    links = start_link_logins(cfg, username, password, timing)
+    state, message = login(username, password, timing=timing, samples=samples)
+    event("login", ok=state in SUCCESS_STATES, state=state.value, ms=_ms_since(started))
+    finish_link_logins(links)
+    # The portal's reply times on this network set the next login's timeouts
+    learned = {}
+    if samples:
+        learned["login_samples"] = ((known or {}).get("login_samples", []) + samples)[-LOGIN_SAMPLES:]
+    if state in SUCCESS_STATES:
+        clear_backoff()
+        save_state("login", fingerprint, cfg, logged_in=True)
+        # Typical login latency on this network (moving average)
+        took = _ms_since(started)
+        previous = (known or {}).get("login_ms")
+        record_network(net_key, portal=True, checked=round(time.time()),
+                       login_ms=took if previous is None else round(0.7 * previous + 0.3 * took, 1), **learned)
+        log("[+] Logged in successfully!")
+        return "login"
+    if learned:
+        record_network(net_key, **learned)
+    if state is PortalState.WRONG_PASSWORD:
+        forget_password(username)
+    if state in TERMINAL_BACKOFF:
+        save_backoff(username, password, state)
+        log(f"[!] Login refused: {state.value}. Backing off for {TERMINAL_BACKOFF[state] // 60} min.")
+    else:
+        log("[*] Login failed after retries. Will try again on the next trigger.")
+    return "failed"
+
+
+def _ms_since(started):
+    return round((time.monotonic() - started) * 1000, 1)
+
+
+def run_coalesced(cfg, use_cache=True):
+    # Only one login run at a time across the daemon, scheduled task, manual
+    # runs and test scripts. A run that finds another in flight waits for its
+    # outcome instead of sending its own probes and login POST.
+    arrived = time.time()
+    lock = FileLock(RUN_LOCK_FILE)
+    if not lock.acquire():
+        log("[*] Another login run is in progress - waiting for its result...")
+        if not lock.acquire(timeout=RUN_LOCK_WAIT):
+            log(f"[*] Other run still busy after {RUN_LOCK_WAIT}s. Giving up.")
+            return
+        last = load_state().get("last_run", {})
+        if last.get("finished_at", 0) >= arrived and last.get("fingerprint") == network_signature():
+            lock.release()
+            log(f"[*] Other run finished: {last.get('outcome') or 'no login'}. Not repeating it.")
+            return last.get("outcome")
+        # It was for another network; this transition still needs a run
+
+    try:
+        configure_tracing(cfg)
+        started = time.monotonic()
+        fingerprint = network_signature()
+        trace("start")
+        outcome = run_once(cfg, use_cache)
+        update_state(last_run={"fingerprint": fingerprint, "outcome": outcome, "finished_at": time.time()})
+        elapsed = _ms_since(started)
+        # Only a failed login counts against the run; off campus or already
+        # online is the run doing its job
+        event("run", ok=outcome != "failed", outcome=outcome, ms=elapsed)
+        trace("end", outcome=outcome, ms=elapsed)
+        if outcome == "login":
+            observe("time_to_internet", elapsed)
+        return outcome
+    finally:
+        lock.release()
+        flush_logs()
+        save_stats(cfg)
+
+
+def network_signature():
+    # Local address the OS would use to reach the portal. Changes on connect,
+    # disconnect and roaming; a UDP connect() sends no packets.
+    host = urllib.parse.urlsplit(PORTAL_BASE).hostname
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((host, 9))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+# ---- Control endpoint ----
+# The daemon answers local clients (test scripts, tray icons, status bars) on
+# a Unix domain socket next to the script, or a named pipe on Windows. One
+# JSON request per line:
+#   {"cmd": "status"}  -> {"ok": true, "status": {...}}, straight from memory
+#   {"cmd": "watch"}   -> the same, then one {"changed": [...], "status": {...}}
+#                         line per change until the client hangs up
+#   {"cmd": "login"}   -> {"ok": true, "queued": true}; the daemon runs a login now
+
+class _ControlStream:
+    # Newline-delimited JSON over a connected socket or pipe
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._reader = io.BufferedReader(raw)
+
+    def send(self, message):
+        data = (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+        while data:
+            data = data[self._raw.write(data):]
+
+    def receive(self):
+        line = self._reader.readline(65536)
+        if not line:
+            raise EOFError("control connection closed")
+        return json.loads(line)
+
+    def close(self):
+        self._reader.close()
+
+
+class _SocketListener:
+
+    def __init__(self, path):
+        try:
+            os.unlink(path)  # left behind by a daemon that died; we hold the daemon lock
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        os.chmod(path, 0o600)
+        self._sock.listen(8)
+
+    def accept(self):
+        conn, _ = self._sock.accept()
+        raw = conn.makefile("rwb", buffering=0)
+        conn.close()  # the file keeps the connection open
+        return raw
+
+
+class _PipeListener:
+    # Each accept() creates a pipe instance and waits for a client on it.
+    # Local clients only; the first instance claims the name.
+
+    PIPE_ACCESS_DUPLEX = 0x3
+    FILE_FLAG_FIRST_PIPE_INSTANCE = 0x80000
+    PIPE_REJECT_REMOTE_CLIENTS = 0x8
+    PIPE_UNLIMITED_INSTANCES = 255
+    ERROR_PIPE_CONNECTED = 535
+
+    def __init__(self, name):
+        self.name = name
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._kernel32.CreateNamedPipeW.restype = wintypes.HANDLE
+        self._kernel32.CreateNamedPipeW.argtypes = [wintypes.LPCWSTR] + [wintypes.DWORD] * 6 + [ctypes.c_void_p]
+        self._kernel32.ConnectNamedPipe.argtypes = [wintypes.HANDLE, ctypes.c_void_p]
+        self._kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        self._first = True
+        self._pending = self._create()
+
+    def _create(self):
+        flags = self.PIPE_ACCESS_DUPLEX | (self.FILE_FLAG_FIRST_PIPE_INSTANCE if self._first else 0)
+        handle = self._kernel32.CreateNamedPipeW(self.name, flags, self.PIPE_REJECT_REMOTE_CLIENTS,
+                                                 self.PIPE_UNLIMITED_INSTANCES, 4096, 4096, 0, None)
+        if handle in (None, wintypes.HANDLE(-1).value):
+            raise ctypes.WinError(ctypes.get_last_error())
+        self._first = False
+        return handle
+
+    def accept(self):
+        handle, self._pending = self._pending, None
+        if handle is None:
+            handle = self._create()
+        if not self._kernel32.ConnectNamedPipe(handle, None):
+            error = ctypes.get_last_error()
+            if error != self.ERROR_PIPE_CONNECTED:
+                self._kernel32.CloseHandle(handle)
+                raise ctypes.WinError(error)
+        return open(msvcrt.open_osfhandle(handle, 0), "r+b", buffering=0)
+
+
+class ControlServer:
+    # The daemon's status, kept in memory and served on the control endpoint.
+    # update() is called from the daemon loop; every client gets a thread.
+
+    def __init__(self):
+        now = time.time()
+        self.status = {"pid": os.getpid(), "started": round(now, 3), "state": "starting",
+                       "since": round(now, 3), "network": None, "logged_in_since": None,
+                       "runs": 0, "last_run": None, "last_keepalive": None, "links": {}}
+        self._lock = threading.Lock()
+        self._watchers = []
+        self._login_requested = False
+        self.waker, self._wake = socket.socketpair()
+        self.waker.setblocking(False)
+
+    def listen(self):
+        try:
+            listener = _PipeListener(CONTROL_PIPE) if os.name == "nt" else _SocketListener(CONTROL_SOCKET)
+        except OSError as e:
+            log(f"[*] Control endpoint unavailable: {e}")
+            return
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                raw = listener.accept()
+            except OSError as e:
+                log(f"[*] Control endpoint: {e}")
+                time.sleep(1)
+                continue
+            threading.Thread(target=self._serve, args=(_ControlStream(raw),), daemon=True).start()
 
+    def snapshot(self):
+        with self._lock:
+            return dict(self.status)
+
+    def update(self, **fields):
+        # Merge fields into the status and push what changed to watchers
+        with self._lock:
+            changed = [k for k, v in fields.items() if self.status.get(k) != v]
+            if not changed:
+                return
+            if "state" in changed:
+                fields["since"] = round(time.time(), 3)
+            self.status.update(fields)
+            message = {"changed": changed, "status": dict(self.status)}
+            for watcher in list(self._watchers):
+                try:
+                    watcher.put_nowait(message)
+                except queue.Full:
+                    # Not reading: drop what it missed and hang up on it
+                    self._watchers.remove(watcher)
+                    try:
+                        while True:
+                            watcher.get_nowait()
+                    except queue.Empty:
+                        watcher.put_nowait(None)
+
+    def take_login_request(self):
+        try:
+            while self.waker.recv(64):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self._lock:
+            requested, self._login_requested = self._login_requested, False
+        return requested
+
+    def wait(self, timeout):
+        # Sleep like the daemon loop does, but wake up for a login request
+        select.select([self.waker], [], [], timeout)
+
+    def _serve(self, stream):
+        watcher = None
+        try:
+            cmd = stream.receive().get("cmd")
+            if cmd == "status":
+                stream.send({"ok": True, "status": self.snapshot()})
+            elif cmd == "login":
+                with self._lock:
+                    self._login_requested = True
+                self._wake.send(b"!")
+                stream.send({"ok": True, "queued": True})
+            elif cmd == "watch":
+                watcher = queue.Queue(maxsize=256)
+                with self._lock:
+                    self._watchers.append(watcher)
+                    stream.send({"ok": True, "status": dict(self.status)})
+                while True:
+                    message = watcher.get()
+                    if message is None:
+                        break
+                    stream.send(message)
+            else:
+                stream.send({"ok": False, "error": f"unknown command {cmd!r}"})
+        except (OSError, ValueError, AttributeError, EOFError):
+            pass
+        finally:
+            if watcher is not None:
+                with self._lock:
+                    if watcher in self._watchers:
+                        self._watchers.remove(watcher)
+            stream.close()
+
+
+def control_connect(timeout=2):
+    # Client side of the control endpoint; raises OSError if no daemon listens
+    if os.name == "nt":
+        end = time.monotonic() + timeout
+        while True:
+            try:
+                return _ControlStream(open(CONTROL_PIPE, "r+b", buffering=0))
+            except OSError:
+                # Busy, or between two pipe instances
+                if time.monotonic() >= end:
+                    raise
+                time.sleep(0.01)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(CONTROL_SOCKET)
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    raw = sock.makefile("rwb", buffering=0)
+    sock.close()
+    return _ControlStream(raw)
+
+
+def _describe_status(status):
+    def clock(ts):
+        return time.strftime("%H:%M:%S", time.localtime(ts)) if ts else "-"
+    line = f"{status['state']} since {clock(status['since'])}, network {status['network'] or '-'}"
+    if status.get("logged_in_since") and status["state"] != "logged in":
+        line += f", logged in since {clock(status['logged_in_since'])}"
+    for name, link in sorted((status.get("links") or {}).items()):
+        line += f", {name} {link['state']}"
+    last = status.get("last_run")
+    if last:
+        line += f", last run {clock(last['at'])} ({last['reason']}: {last['outcome'] or 'no login'}, {last['ms']:.0f} ms)"
+    return line
+
+
+def control_client(cmd, follow=False):
+    # status / trigger commands: ask the running daemon
+    try:
+        stream = control_connect()
+    except OSError:
+        print("[!] No daemon is running (control endpoint not found).")
+        return False
     try:
-        status, message = sophos_login(username, password)
-        log(f"[*] Portal response: status={status}, message={message}")
-        if status == "LIVE":
-            log("[+] Logged in successfully!")
+        if cmd == "login":
+            stream.send({"cmd": "login"})
+            stream.receive()
+            print("[*] The daemon will log in now.")
+            if not follow:
+                return True
+            stream.close()
+            stream = control_connect()
+        stream.send({"cmd": "watch" if follow else "status"})
+        print(_describe_status(stream.receive()["status"]))
+        while follow:
+            message = stream.receive()
+            print(f"{time.strftime('%H:%M:%S')} {', '.join(message['changed'])}: "
+                  f"{_describe_status(message['status'])}")
+        return True
+    except (KeyboardInterrupt, EOFError):
+        return True
+    finally:
+        stream.close()
+
+
+def run_daemon():
+    daemon_lock = FileLock(DAEMON_LOCK_FILE)
+    if not daemon_lock.acquire():
+        log("[*] Daemon already running. Exiting.")
+        return
+    log(f"[*] Daemon started (pid {os.getpid()}).")
+    cfg = load_config()
+    configure_tracing(cfg)
+    cfg_mtime = _mtime(CONFIG_FILE)
+    last_sig = None
+    last_links = ()
+    last_wall = time.time()
+    last_check = 0.0
+    keepalive_at = None
+    monitor = SessionMonitor()
+    control = ControlServer()
+    control.listen()
+    # Kernel change events on Linux; elsewhere (or without netlink) we poll
+    events = RouteEvents.open()
+    changes = []
+    while True:
+        sig = network_signature()
+        # Addresses of the other interfaces towards the portal (cached by the
+        # provider until the network changes)
+        links = tuple(sorted(link["address"] for link in other_links(cfg)))
+        wall = time.time()
+        now = time.monotonic()
+
+        if changes:
+            log(f"[*] Kernel: {'; '.join(changes)}")
+        if sig != last_sig or wall - last_wall > DAEMON_POLL * 5:
+            drop_connections()
+        elif links != last_links:
+            drop_connections(keep=links)
+        reason = None
+        if sig != last_sig:
+            reason = f"network change ({sig or 'no route'})"
+            keepalive_at = None
+            monitor = SessionMonitor()
+            trace("net", sig=sig)
+            link_sessions.clear()
+            control.update(network=sig, logged_in_since=None, links={})
+        elif control.take_login_request():
+            reason = "login requested"
+        elif links != last_links:
+            reason = f"interfaces changed ({', '.join(links) or 'default route only'})"
+        elif changes:
+            reason = "route or address change"
+        elif wall - last_wall > DAEMON_POLL * 5:
+            reason = "wake from sleep"
+            trace("wake", slept=round(wall - last_wall, 1))
+        elif keepalive_at is not None and now >= keepalive_at:
+            keepalive_at = send_keepalive(cfg)
+            if keepalive_at is None:
+                reason = "keepalive rejected"
+                monitor.stop()
+                control.update(state="session dropped", logged_in_since=None)
+            else:
+                control.update(last_keepalive=round(time.time(), 3))
+        elif monitor.due is not None and now >= monitor.due:
+            if not monitor.check():
+                reason = "session dropped"
+                control.update(state="session dropped", logged_in_since=None)
+        elif now - last_check >= DAEMON_RECHECK and monitor.due is None:
+            # The health monitor, when running, stands in for this
+            reason = "periodic check"
+        last_sig, last_links, last_wall = sig, links, wall
+
+        if reason and sig:
+            if _mtime(CONFIG_FILE) != cfg_mtime:
+                cfg = load_config()
+                cfg_mtime = _mtime(CONFIG_FILE)
+                _password_cache.clear()  # setup may have stored a new password
+            # Periodic checks stay silent while the internet works, and
+            # don't even probe on networks known not to have the portal
+            if reason != "periodic check" or (
+                    not portal_absent(known_network(network_fingerprint()), cfg)
+                    and probe_network()[0] != "online"):
+                log(f"[*] Trigger: {reason}")
+                control.update(state="checking")
+                started = time.monotonic()
+                try:
+                    outcome = run_coalesced(cfg, use_cache=False)
+                except Exception as e:
+                    log(f"[!] Login run failed: {e}")
+                    outcome = None
+                finished = {"state": {"login": "logged in", "online": "online",
+                                      "off-campus": "off campus"}.get(outcome, "offline"),
+                            "runs": control.status["runs"] + 1,
+                            "last_run": {"at": round(time.time(), 3), "reason": reason, "outcome": outcome,
+                                         "ms": _ms_since(started)},
+                            "links": {name: {"address": link["address"], "state": link["state"]}
+                                      for name, link in link_sessions.items()}}
+                if outcome == "login":
+                    finished["logged_in_since"] = round(time.time(), 3)
+                control.update(**finished)
+                # Keep our own session alive; leave the schedule alone if the
+                # internet already worked (e.g. after a short sleep)
+                if outcome == "login":
+                    keepalive_at = time.monotonic() + keepalive_delay(cfg)
+                    monitor.start(cfg)
+                elif outcome != "online":
+                    keepalive_at = None
+                    monitor.stop()
+                elif (known_network(network_fingerprint()) or {}).get("portal"):
+                    # Already online on a campus network (our session from
+                    # before a wake, say): keep it alive and watch it too
+                    if keepalive_at is None:
+                        keepalive_at = time.monotonic() + keepalive_delay(cfg)
+                    if monitor.due is None:
+                        monitor.start(cfg)
+            last_check = time.monotonic()
+
+        flush_logs()
+        save_stats(cfg)
+        if events:
+            changes = events.wait(DAEMON_POLL, (control.waker,))
         else:
-            log(f"[*] Login returned unexpected status: {status}")
+            control.wait(DAEMON_POLL)
+
+
+# ---- Batch mode ----
+# Logs in (and optionally keeps alive) a whole roster of accounts, each
+# optionally from its own source address. Workers share one rate limiter so
+# the portal sees a steady trickle instead of a burst.
+
+class RateLimiter:
+    # Token bucket: rate requests a second on average, bursts of up to burst.
+    # A rate of 0 or less means no limit.
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            # Going negative reserves a later slot for this caller
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def load_roster(path):
+    # CSV lines "username,password[,source address]". Blank lines, # comments
+    # and a "username,..." header are skipped.
+    import csv
+    accounts = []
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#") or row[0].lower() == "username":
+                continue
+            if len(row) < 2:
+                raise ValueError(f"{path}: no password for {row[0]}")
+            accounts.append({"username": row[0], "password": row[1],
+                             "source": row[2] if len(row) > 2 and row[2] else None})
+    return accounts
+
+
+class _BatchPools:
+    # One HTTPPool per (worker thread, source address): workers never wait on
+    # each other's connections, and each keeps its keep-alive connection
+    # across the accounts it handles.
+
+    def __init__(self):
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def get(self, source):
+        pools = getattr(self._local, "pools", None)
+        if pools is None:
+            pools = self._local.pools = {}
+        if source not in pools:
+            pools[source] = HTTPPool(source)
+            with self._lock:
+                self._all.append(pools[source])
+        return pools[source]
+
+    def close(self):
+        with self._lock:
+            for pool in self._all:
+                pool.close()
+
+
+def _batch_login_one(account, pools, limiter, budget):
+    # login() for one roster entry, with every attempt going through the
+    # shared rate limiter
+    started = time.monotonic()
+    pool = pools.get(account["source"])
+    delay = LOGIN_RETRY_DELAY
+    for attempt in range(1, budget + 1):
+        limiter.acquire()
+        try:
+            status, message = sophos_login(account["username"], account["password"], pool)
+            state = classify_response(status, message)
+        except Exception as e:
+            state, message = PortalState.TRANSIENT, str(e)
+        if state is not PortalState.TRANSIENT or attempt == budget:
+            break
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay *= 2
+    return {"username": account["username"], "source": account["source"], "state": state,
+            "message": message, "attempts": attempt, "ms": _ms_since(started), "keepalives": 0}
+
+
+def _batch_keepalive_one(account, result, pools, limiter, budget):
+    # Keep a live session going; log in again if the portal dropped it
+    limiter.acquire()
+    try:
+        ok = sophos_keepalive(account["username"], pools.get(account["source"]))
     except Exception as e:
-        log(f"[*] Login request failed: {e}")
+        ok, result["message"] = None, str(e)
+    if ok:
+        result["keepalives"] += 1
+    elif ok is False:
+        relogin = _batch_login_one(account, pools, limiter, budget)
+        relogin["keepalives"] = result["keepalives"]
+        result.update(relogin)
+    return result
+
+
+def batch_login(accounts, parallel=BATCH_PARALLEL, rate=BATCH_RATE, budget=LOGIN_RETRY_BUDGET,
+                hold=0, session_timeout=SESSION_TIMEOUT):
+    # Log in every account with at most `parallel` in flight, then keep the
+    # live ones alive for `hold` seconds. Returns one result dict per
+    # account, in roster order.
+    import concurrent.futures
+    limiter = RateLimiter(rate, burst=max(1, parallel))
+    pools = _BatchPools()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as workers:
+            results = list(workers.map(lambda a: _batch_login_one(a, pools, limiter, budget), accounts))
+            end = time.monotonic() + hold
+            while True:
+                pause = keepalive_delay({"session_timeout": session_timeout})
+                if time.monotonic() + pause > end:
+                    break
+                time.sleep(pause)
+                live = [(a, r) for a, r in zip(accounts, results) if r["state"] in SUCCESS_STATES]
+                list(workers.map(lambda ar: _batch_keepalive_one(*ar, pools, limiter, budget), live))
+                log(f"[*] Batch keepalive round: "
+                    f"{sum(r['state'] in SUCCESS_STATES for r in results)}/{len(results)} live")
+    finally:
+        pools.close()
+    return results
+
+
+def print_batch_results(results, elapsed):
+    print(f"{'username':<20}{'source':<17}{'state':<28}{'tries':>6}{'ms':>9}{'keepalives':>12}")
+    for r in results:
+        print(f"{r['username']:<20}{r['source'] or '-':<17}{r['state'].value:<28}"
+              f"{r['attempts']:>6}{r['ms']:>9.0f}{r['keepalives']:>12}")
+    live = sum(r["state"] in SUCCESS_STATES for r in results)
+    print(f"{live}/{len(results)} accounts live after {elapsed:.1f}s")
+    for state in PortalState:
+        count = sum(r["state"] is state for r in results)
+        if count and state not in SUCCESS_STATES:
+            print(f"  {state.value}: {count}")
+
+
+def run_batch(roster, parallel, rate, hold):
+    cfg = load_config()
+    try:
+        accounts = load_roster(roster)
+    except (OSError, ValueError) as e:
+        log(f"[!] Can't read roster: {e}")
+        return False
+    log(f"[*] Batch login: {len(accounts)} accounts, {parallel} at a time, {rate} requests/s")
+    started = time.monotonic()
+    results = batch_login(accounts, parallel, rate, hold=hold,
+                          session_timeout=cfg.get("session_timeout", SESSION_TIMEOUT))
+    elapsed = time.monotonic() - started
+    live = sum(r["state"] in SUCCESS_STATES for r in results)
+    event("batch", ok=live == len(results), accounts=len(results), live=live, ms=round(elapsed * 1000, 1))
+    print_batch_results(results, elapsed)
+    save_stats(cfg)
+    return live == len(results)
+
+
+def watch_events():
+    events = RouteEvents.open()
+    if events is None:
+        print("[!] Kernel network events are only available on Linux.")
+        return
+    print("[*] Watching for route, address and link changes (Ctrl+C to stop)...")
+    try:
+        while True:
+            changes = events.wait(3600)
+            if changes:
+                print(f"{time.strftime('%H:%M:%S')} {'; '.join(changes)} -> "
+                      f"route to portal: {_describe_route(LinuxNetwork().gateway())}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.close()
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def main():
+    # A plain run (what every trigger does) skips argparse: this is the
+    # cold-start path, and nothing on it should import more than it uses
+    if len(sys.argv) == 1:
+        run_coalesced(load_config())
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description="NUJS-CAMPUS WiFi auto-login")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and log in whenever the network changes")
+    parser.add_argument("--watch", action="store_true",
+                        help="Linux: print route/address/link changes as the daemon sees them")
+    parser.add_argument("--tail", type=int, metavar="N",
+                        help="print the last N structured events and exit")
+    parser.add_argument("command", nargs="?", default="login",
+                        choices=["login", "stats", "batch", "networks", "status", "trigger", "set-password"],
+                        help="login (default), stats: print phase timings and failure rates, "
+                             "batch: log in every account in ROSTER, "
+                             "networks: list the networks seen and what they turned out to be, "
+                             "status: ask the running daemon whether we're logged in, "
+                             "trigger: have the running daemon log in now, "
+                             "or set-password: save the password in a credential store")
+    parser.add_argument("roster", nargs="?",
+                        help="batch only: CSV of username,password[,source address]")
+    parser.add_argument("--store", choices=[cls.name for cls in CREDENTIAL_STORES] + ["auto"],
+                        help="set-password: where to keep it (default: the OS secret store, "
+                             "else an encrypted file)")
+    parser.add_argument("--follow", action="store_true",
+                        help="status/trigger: keep printing the daemon's state changes")
+    parser.add_argument("--window", default="7d",
+                        help="time span for stats, e.g. 12h, 7d, 4w (default: 7d)")
+    parser.add_argument("--parallel", type=int, default=BATCH_PARALLEL,
+                        help=f"batch: logins in flight at once (default: {BATCH_PARALLEL})")
+    parser.add_argument("--rate", type=float, default=BATCH_RATE,
+                        help=f"batch: max portal requests per second, 0 for no limit (default: {BATCH_RATE})")
+    parser.add_argument("--hold", type=float, default=0, metavar="SECONDS",
+                        help="batch: keep the sessions alive this long after logging in")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print_stats(args.window)
+    elif args.command == "networks":
+        print_networks()
+    elif args.command == "set-password":
+        sys.exit(0 if set_password_interactive(args.store) else 1)
+    elif args.command in ("status", "trigger"):
+        sys.exit(0 if control_client("login" if args.command == "trigger" else "status", args.follow) else 1)
+    elif args.command == "batch":
+        if not args.roster:
+            parser.error("batch needs a roster file")
+        sys.exit(0 if run_batch(args.roster, args.parallel, args.rate, args.hold) else 1)
+    elif args.tail:
+        for record in recent_events(args.tail):
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.pop("ts", 0)))
+            phase = record.pop("phase", "?")
+            print(f"{ts} {phase:<12} " + " ".join(f"{k}={v}" for k, v in record.items()))
+    elif args.watch:
+        watch_events()
+    elif args.daemon:
+        run_daemon()
+    else:
+        run_coalesced(load_config())
 
 
 if __name__ == "__main__":
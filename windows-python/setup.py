@@ -1,11 +1,16 @@
 """
 Setup script for NUJS WiFi auto-login on Windows.
-Installs the script, saves credentials, creates a Scheduled Task.
+Installs the script, saves the password in Windows Credential Manager,
+creates a Scheduled Task.
+
+    python setup.py [--zipapp]
+
+--zipapp also installs the script precompiled as nujs-wifi-login.pyz and
+points the task at it (saves compiling the script on every start).
 """
 
 import subprocess
 import shutil
-import json
 import os
 import sys
 import tempfile
@@ -33,6 +38,34 @@ def is_admin():
         return False
 
 
+def build_zipapp(src_script, dst):
+    # Bytecode compiled once here instead of on every start. The source goes
+    # in too: zipimport falls back to it if a different Python runs the .pyz.
+    import py_compile
+    import zipfile
+    with tempfile.TemporaryDirectory() as tmp:
+        pyc = os.path.join(tmp, "nujs_wifi_login.pyc")
+        py_compile.compile(src_script, cfile=pyc, dfile="nujs_wifi_login.py", doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with zipfile.ZipFile(dst, "w") as z:
+            z.writestr("__main__.py", "import nujs_wifi_login\nnujs_wifi_login.main()\n")
+            z.write(pyc, "nujs_wifi_login.pyc")
+            z.write(src_script, "nujs_wifi_login.py")
+
+
+def load_login_script(path):
+    # The installed login script as a module, for its credential stores
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("nujs_wifi_login", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.CONFIG_FILE = os.path.join(INSTALL_DIR, "config.json")
+    module.SECRETS_FILE = os.path.join(INSTALL_DIR, "secrets.json")
+    module.SECRETS_KEY_FILE = os.path.join(INSTALL_DIR, "secrets.key")
+    module.BACKOFF_FILE = os.path.join(INSTALL_DIR, "login-backoff.json")
+    return module
+
+
 def main():
     log("=== NUJS WiFi Auto-Login Setup (Windows - Python) ===")
     log(f"Python: {sys.version}")
@@ -55,12 +88,22 @@ def main():
     dst_script = os.path.join(INSTALL_DIR, "nujs-wifi-login.py")
     shutil.copy2(src_script, dst_script)
     log(f"[+] Script installed to {dst_script}")
-
-    # Save credentials
-    config_file = os.path.join(INSTALL_DIR, "config.json")
-    with open(config_file, "w") as f:
-        json.dump({"username": username, "password": password}, f)
-    log("[+] Credentials saved to config.json")
+    if "--zipapp" in sys.argv[1:]:
+        dst_script = os.path.join(INSTALL_DIR, "nujs-wifi-login.pyz")
+        build_zipapp(src_script, dst_script)
+        log(f"[+] Precompiled zipapp installed to {dst_script}")
+
+    # Save credentials: the password goes to Credential Manager, config.json
+    # only keeps the username and where the password is
+    login = load_login_script(os.path.join(INSTALL_DIR, "nujs-wifi-login.py"))
+    try:
+        store = login.store_credentials(username, password)
+        log(f"[+] Password saved to the credential store ({store.name}), username to config.json")
+    except Exception as e:
+        log(f"[!] Credential store unavailable ({e}); saving the password in config.json instead")
+        login.store_credentials(username, password, "config")
+    # New credentials deserve a fresh try even if the portal refused the old ones
+    login.clear_backoff()
 
     # Find python path
     python_path = sys.executable
@@ -72,7 +115,8 @@ def main():
             python_path = pythonw_path
     log(f"[*] Using Python: {python_path}")
 
-    # Remove old task
+    # Stop and remove old task
+    subprocess.run(["schtasks", "/End", "/TN", TASK_NAME], capture_output=True)
     subprocess.run(
         ["schtasks", "/Delete", "/TN", TASK_NAME, "/F"],
         capture_output=True
@@ -109,12 +153,16 @@ def main():
     <AllowStartOnDemand>true</AllowStartOnDemand>
     <Enabled>true</Enabled>
     <Hidden>false</Hidden>
-    <ExecutionTimeLimit>PT5M</ExecutionTimeLimit>
+    <ExecutionTimeLimit>PT0S</ExecutionTimeLimit>
+    <RestartOnFailure>
+      <Interval>PT1M</Interval>
+      <Count>3</Count>
+    </RestartOnFailure>
   </Settings>
   <Actions>
     <Exec>
       <Command>{python_path}</Command>
-      <Arguments>"{dst_script}"</Arguments>
+      <Arguments>"{dst_script}" --daemon</Arguments>
     </Exec>
   </Actions>
 </Task>"""
@@ -132,11 +180,14 @@ def main():
     os.remove(xml_path)
 
     if result.returncode == 0:
-        log("[+] Scheduled task created with triggers:")
+        log("[+] Scheduled task created. It starts the resident login daemon on:")
         log("      - At logon")
         log("      - At startup")
         log("      - On wake from sleep")
         log("      - On network connect")
+        log("      (triggers are ignored while the daemon is already running)")
+        subprocess.run(["schtasks", "/Run", "/TN", TASK_NAME], capture_output=True)
+        log("[+] Daemon started.")
     else:
         log(f"[!] Failed to create scheduled task: {result.stderr.strip()}")
         log("[*] You may need to run this as Administrator.")
@@ -0,0 +1,422 @@
+"""
+Replay simulator for the NUJS WiFi login script's timing policies.
+Reads traces recorded with "trace": true in config.json
+(nujs-wifi-trace.jsonl and its rotated copies), rebuilds what the network did
+(how long the portal took to come up, how each login POST answered, when the
+portal dropped a session) and replays it through the script's own portal
+wait, login retry and keepalive code on a virtual clock. Prints outage seconds
+and request counts per policy; days of history replay in seconds.
+
+Usage:  python simulate.py [TRACE ...] [--policy NAME ...] [--set NAME:KEY=VALUE ...]
+
+The moment a network change is noticed comes from the trace; policies change
+what happens after it.
+"""
+
+import argparse
+import heapq
+import importlib.util
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TRACE = os.path.join(SCRIPT_DIR, "nujs-wifi-trace.jsonl")
+
+# name -> overrides. UPPER_CASE keys replace the script's constants,
+# lower_case keys go into its config (session_timeout sets the keepalive cadence).
+POLICIES = {
+    "current": {},
+    "fixed-3s": {"PORTAL_WAIT_FIRST": 3, "PORTAL_WAIT_MAX": 3},
+    "eager-wait": {"PORTAL_WAIT_FIRST": 0.05, "PORTAL_WAIT_MAX": 0.5},
+    "patient-wait": {"PORTAL_WAIT_FIRST": 1, "PORTAL_WAIT_MAX": 8},
+    "fast-retry": {"LOGIN_RETRY_DELAY": 0.25},
+    "keepalive-90s": {"session_timeout": 180},
+    "keepalive-450s": {"session_timeout": 900},
+}
+
+
+class VirtualTime:
+    # Stands in for the time module inside the script: the clock only moves
+    # when the script sleeps or the replayed network makes it wait
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class VirtualThreads:
+    # Stands in for the threading module: a thread runs to completion inside
+    # start() and the clock is then wound back, so its sleeps overlap the
+    # caller's
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def Thread(self, target, args=(), kwargs=None, daemon=None):
+        return _VirtualThread(self.clock, target, args, kwargs or {})
+
+    def __getattr__(self, name):
+        return getattr(threading, name)
+
+
+class VirtualQueues:
+    # Stands in for the queue module: each put is stamped with the virtual
+    # time it happened and items come out in that order, so a
+    # get(timeout=...) in the script (the login hedge timer) waits on the
+    # virtual clock
+
+    Empty = queue.Empty
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def Queue(self):
+        return _VirtualQueue(self.clock)
+
+    def __getattr__(self, name):
+        return getattr(queue, name)
+
+
+class _VirtualThread:
+
+    def __init__(self, clock, target, args, kwargs):
+        self.clock = clock
+        self.run = lambda: target(*args, **kwargs)
+
+    def start(self):
+        started = self.clock.now
+        self.run()
+        self.clock.now = started
+
+
+class _VirtualQueue:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.items = []  # heap of (virtual time put, order, item)
+        self.order = 0
+
+    def put(self, item):
+        heapq.heappush(self.items, (self.clock.now, self.order, item))
+        self.order += 1
+
+    def get(self, timeout=None):
+        if self.items and (timeout is None or self.items[0][0] <= self.clock.now + timeout):
+            at, _, item = heapq.heappop(self.items)
+            self.clock.now = max(self.clock.now, at)
+            return item
+        if timeout is None:
+            raise RuntimeError("get() on an empty virtual queue would block forever")
+        self.clock.now += timeout
+        raise queue.Empty
+
+
+class ReplayedNetwork:
+    # The portal as one episode of the trace saw it; counts every request the
+    # script makes against it. A login POST sent while another is still
+    # unanswered (the script's hedge) goes over a fresh connection and is
+    # answered in fresh_s, the trace's typical login time.
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.requests = {"probe": 0, "tcp": 0, "login": 0, "live": 0}
+        self.fresh_s = 0.05
+        self.busy_until = 0.0
+
+    def load(self, episode):
+        self.ready_at = episode["ready_at"]
+        self.connect_s = episode["connect_s"]
+        self.refuse_s = episode["refuse_s"]
+        self.logins = list(episode["logins"])
+        self.busy_until = 0.0
+
+    def portal_accepts_tcp(self, timeout, source=None):
+        self.requests["tcp"] += 1
+        if self.ready_at is not None and self.clock.now >= self.ready_at:
+            self.clock.sleep(min(self.connect_s, timeout))
+            return True
+        self.clock.sleep(min(self.refuse_s, timeout))
+        return False
+
+    def sophos_login(self, username, password, pool=None, timeout=None):
+        self.requests["login"] += 1
+        if self.clock.now < self.busy_until:
+            state, seconds = self.logins[0][0], min(self.fresh_s, self.logins[0][1])
+        else:
+            state, seconds = self.logins.pop(0) if len(self.logins) > 1 else self.logins[0]
+            self.busy_until = self.clock.now + seconds
+        self.clock.sleep(seconds)
+        if state == "TRANSIENT":
+            raise ConnectionError("replayed transient failure")
+        return state, ""
+
+
+def load_script(seed):
+    spec = importlib.util.spec_from_file_location("nujs_wifi_login", os.path.join(SCRIPT_DIR, "nujs-wifi-login.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.random = random.Random(seed)
+    module.log = module.event = module.trace = lambda *args, **kwargs: None
+    return module
+
+
+def read_trace(paths):
+    records = []
+    for path in paths:
+        # Rotated copies first, oldest (.5) to newest
+        for name in [f"{path}.{i}" for i in range(9, 0, -1)] + [path]:
+            if not os.path.exists(name):
+                continue
+            with open(name, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def _median(values, default=None):
+    values = sorted(values)
+    return values[len(values) // 2] if values else default
+
+
+def build_episodes(records):
+    # One episode per login run ("start" .. "end"), with the session that
+    # followed it until the next run or network change
+    episodes = []
+    current = None
+    for r in records:
+        kind = r["k"]
+        if kind == "start" and current is not None and current["rejected"]:
+            # The daemon logging in again after a rejected keepalive: part of
+            # the session, which replay_session plays out under each policy
+            current["rejected"], current["relogging"] = False, True
+        elif kind == "start":
+            current = {"t": r["t"], "race": None, "tcp": [], "logins": [], "live": [],
+                       "probes": 0, "outcome": None, "end": None, "until": None,
+                       "rejected": False, "relogging": False}
+            episodes.append(current)
+        elif current is None:
+            continue
+        elif current["relogging"]:
+            current["relogging"] = kind != "end"
+        elif kind == "race":
+            current["race"] = r
+        elif kind == "probe":
+            current["probes"] += 1
+        elif kind == "tcp" and current["end"] is None:
+            current["tcp"].append(r)
+        elif kind == "login" and current["end"] is None:
+            current["logins"].append((r["state"], r["ms"] / 1000))
+        elif kind == "end":
+            current["end"], current["outcome"] = r["t"], r.get("outcome")
+        elif kind == "live" and current["end"] is not None:
+            current["live"].append(r)
+            current["rejected"] = r["ok"] is False
+        elif kind in ("net", "wake") and current["until"] is None:
+            current["until"] = r["t"]
+
+    last = records[-1]["t"] if records else 0
+    for episode, following in zip(episodes, episodes[1:] + [None]):
+        bound = following["t"] if following else last
+        episode["until"] = min(episode["until"] or bound, bound)
+        _describe_world(episode)
+    return [e for e in episodes if e["end"] is not None]
+
+
+def _describe_world(episode):
+    # When (seconds after the probe race) the portal started accepting
+    # connections: between the last refused attempt and the first accepted one
+    race = episode["race"] or {}
+    race_end = race.get("t", episode["t"])
+    episode["race_s"] = race.get("ms", 0) / 1000
+    episode["online"] = race.get("verdict") == "online"
+    refused = [r for r in episode["tcp"] if not r["ok"]]
+    accepted = [r for r in episode["tcp"] if r["ok"]]
+    episode["refuse_s"] = _median([r["ms"] / 1000 for r in refused], 0.5)
+    episode["connect_s"] = accepted[0]["ms"] / 1000 if accepted else 0.005
+    if race.get("portal"):
+        episode["ready_at"] = episode["race_s"]
+    elif accepted:
+        opened = accepted[0]["t"] - accepted[0]["ms"] / 1000
+        before = [r["t"] for r in refused if r["t"] <= opened]
+        low = max(before) if before else opened
+        episode["ready_at"] = episode["race_s"] + max(0.0, (low + opened) / 2 - race_end)
+    else:
+        episode["ready_at"] = None
+    # Portal drops: somewhere between the last acked keepalive and the rejection
+    drops, previous = [], episode["end"]
+    for r in episode["live"]:
+        if r["ok"] is False:
+            drops.append((previous + r["t"]) / 2)
+        previous = r["t"]
+    episode["drops"] = drops
+
+
+def replay_run(m, clock, net, episode, cfg):
+    # Seconds from the trigger to internet under this policy, or None
+    clock.now = 0.0
+    net.load(episode)
+    net.requests["probe"] += episode["probes"]
+    clock.sleep(episode["race_s"])
+    if episode["online"]:
+        return None
+    if episode["ready_at"] is None or episode["ready_at"] > episode["race_s"]:
+        waited, _ = m.wait_for_portal(cfg.get("portal_wait_deadline", m.PORTAL_WAIT_DEADLINE))
+        if waited is None:
+            return None
+    if not episode["logins"]:
+        return None
+    state, _ = m.login("sim", "sim", m.LOGIN_RETRY_BUDGET)
+    return clock.now if state in m.SUCCESS_STATES else None
+
+
+def replay_session(m, net, episode, cfg, portal_timeout, relogin_s, race_probes):
+    # Keepalives at the policy's cadence against a portal that drops the
+    # session at the recorded times, and whenever it goes portal_timeout
+    # seconds without hearing from us. A dead session is noticed by the next
+    # keepalive or the daemon's periodic check (a probe race every
+    # DAEMON_RECHECK seconds), whichever comes first. Returns outage seconds.
+    if episode["outcome"] not in ("login", "online"):
+        return 0.0
+    start, end = episode["end"], episode["until"]
+    drops = list(episode["drops"])
+    outage = 0.0
+    heard = now = start
+    while now < end:
+        due = now + m.keepalive_delay(cfg)
+        lost = [d for d in drops if d <= due]
+        if due - heard > portal_timeout:
+            lost.append(heard + portal_timeout)
+        lost_at = min(lost) if lost else None
+        if lost_at is None or lost_at >= end:
+            if due < end:
+                net.requests["live"] += 1
+            heard = now = due
+            continue
+        # First periodic check after the session died
+        check = lost_at + (-(lost_at - start)) % m.DAEMON_RECHECK
+        noticed = min(due, check)
+        if noticed >= end:
+            outage += end - lost_at
+            break
+        if noticed == due:
+            net.requests["live"] += 1
+        net.requests["login"] += 1
+        outage += noticed + relogin_s - lost_at
+        heard = now = noticed + relogin_s
+        drops = [d for d in drops if d > noticed]
+    net.requests["probe"] += int((end - start) // m.DAEMON_RECHECK) * race_probes
+    return outage
+
+
+def simulate(episodes, name, policy, base_cfg, portal_timeout, seed):
+    m = load_script(seed)
+    clock = VirtualTime()
+    net = ReplayedNetwork(clock)
+    m.time = clock
+    m.threading = VirtualThreads(clock)
+    m.queue = VirtualQueues(clock)
+    m.portal_accepts_tcp = net.portal_accepts_tcp
+    m.sophos_login = net.sophos_login
+    m.classify_response = lambda status, message: m.PortalState[status]
+    cfg = dict(base_cfg)
+    for key, value in policy.items():
+        if key.isupper():
+            setattr(m, key, value)
+        else:
+            cfg[key] = value
+
+    logins = [s for e in episodes for state, s in e["logins"] if state in ("LIVE", "ALREADY_LIVE")]
+    relogin_s = _median(logins, 0.05)
+    net.fresh_s = relogin_s
+    race_probes = _median([e["probes"] for e in episodes], 0)
+    to_internet, outage = [], 0.0
+    for episode in episodes:
+        took = replay_run(m, clock, net, episode, cfg)
+        if took is not None:
+            to_internet.append(took)
+            outage += took
+        outage += replay_session(m, net, episode, cfg, portal_timeout, relogin_s, race_probes)
+    return {"policy": name, "outage": outage, "to_internet": sorted(to_internet), **net.requests}
+
+
+def _parse_set(items):
+    custom = {}
+    for item in items or []:
+        name, _, assignment = item.partition(":")
+        key, _, value = assignment.partition("=")
+        if not key or not value:
+            raise SystemExit(f"bad --set '{item}', expected NAME:KEY=VALUE")
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        custom.setdefault(name, dict(POLICIES.get(name, {})))[key] = value
+    return custom
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traces against timing policies")
+    parser.add_argument("traces", nargs="*", default=[DEFAULT_TRACE],
+                        help="trace files (rotated .1 .. .9 copies are read too)")
+    parser.add_argument("--policy", action="append",
+                        help="policy to replay (repeatable, default: all built-in and --set ones)")
+    parser.add_argument("--set", action="append", metavar="NAME:KEY=VALUE",
+                        help="define or tweak a policy, e.g. quick:PORTAL_WAIT_MAX=1")
+    parser.add_argument("--portal-timeout", type=float, default=360,
+                        help="seconds the portal keeps a silent session (default: 360)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    policies = dict(POLICIES)
+    policies.update(_parse_set(args.set))
+    names = args.policy or list(policies)
+    unknown = [n for n in names if n not in policies]
+    if unknown:
+        parser.error(f"unknown policy: {', '.join(unknown)}")
+
+    records = read_trace(args.traces)
+    episodes = build_episodes(records)
+    if not episodes:
+        print("[!] No login runs in the trace. Set \"trace\": true in config.json and let the daemon run.")
+        return 1
+    span = (records[-1]["t"] - records[0]["t"]) / 3600
+    print(f"Trace: {len(episodes)} runs over {span:.1f}h, "
+          f"{sum(len(e['drops']) for e in episodes)} session drops")
+
+    base_cfg = {"session_timeout": args.portal_timeout}
+    started = time.perf_counter()
+    print(f"{'policy':<16}{'outage s':>10}{'logins':>8}{'p50 s':>8}{'p95 s':>8}"
+          f"{'probe':>7}{'tcp':>7}{'login':>7}{'live':>7}")
+    for name in names:
+        r = simulate(episodes, name, policies[name], base_cfg, args.portal_timeout, args.seed)
+        times = r["to_internet"]
+        p50 = f"{times[len(times) // 2]:.2f}" if times else "-"
+        p95 = f"{times[min(len(times) - 1, int(len(times) * 0.95))]:.2f}" if times else "-"
+        print(f"{name:<16}{r['outage']:>10.1f}{len(times):>8}{p50:>8}{p95:>8}"
+              f"{r['probe']:>7}{r['tcp']:>7}{r['login']:>7}{r['live']:>7}")
+    print(f"({len(names)} policies replayed in {time.perf_counter() - started:.2f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,8 @@ End-to-end test for NUJS WiFi auto-login on Windows.
 Disconnects WiFi, reconnects, waits for the Scheduled Task to auto-login.
 """
 
+import importlib.util
+import json
 import subprocess
 import time
 import os
@@ -13,9 +15,11 @@ TARGET_SSID = "NUJS-CAMPUS WiFi"
 INSTALL_DIR = r"C:\Scripts\nujs-wifi"
 LOGIN_SCRIPT = os.path.join(INSTALL_DIR, "nujs-wifi-login.py")
 LOGIN_LOG = os.path.join(INSTALL_DIR, "nujs-wifi-login.log")
+EVENTS_FILE = os.path.join(INSTALL_DIR, "nujs-wifi-events.jsonl")
 SCRIPT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 TEST_LOG = os.path.join(SCRIPT_DIR, "test-log.txt")
 TASK_NAME = "NUJS-WiFi-AutoLogin"
+CONTROL_PIPE = r"\\.\pipe\nujs-wifi-login"
 
 
 def log(msg):
@@ -39,6 +43,33 @@ def get_wifi_ssid():
     return None
 
 
+def load_login_script(path):
+    # The installed login script as a module, for its log readers
+    spec = importlib.util.spec_from_file_location("nujs_wifi_login", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.LOG_FILE = LOGIN_LOG
+    module.EVENTS_FILE = EVENTS_FILE
+    return module
+
+
+def daemon_status():
+    # The login daemon's status from its control pipe (answered from memory),
+    # or None if no daemon is running
+    try:
+        with open(CONTROL_PIPE, "r+b", buffering=0) as pipe:
+            pipe.write(b'{"cmd":"status"}\n')
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = pipe.read(4096)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data)["status"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
 def internet_is_working():
     try:
         resp = urllib.request.urlopen("http://captive.apple.com/hotspot-detect.html", timeout=5)
@@ -63,6 +94,7 @@ def main():
         input("Press Enter to exit...")
         return
     log("      Login script found.")
+    login = load_login_script(LOGIN_SCRIPT)
 
     result = subprocess.run(["schtasks", "/Query", "/TN", TASK_NAME],
                             capture_output=True, text=True)
@@ -91,7 +123,8 @@ def main():
         return
     log("      Internet is working.")
 
-    # Step 4: Record log size
+    # Step 4: Note how many runs the daemon has done (or, without one, the log size)
+    status_before = daemon_status()
     log_size_before = 0
     if os.path.exists(LOGIN_LOG):
         log_size_before = os.path.getsize(LOGIN_LOG)
@@ -127,18 +160,26 @@ def main():
     log("[6/6] Results")
     log("")
 
-    script_ran = False
-    if os.path.exists(LOGIN_LOG):
-        log_size_after = os.path.getsize(LOGIN_LOG)
-        if log_size_after > log_size_before:
-            script_ran = True
-            log("--- Login script log (last entries) ---")
-            with open(LOGIN_LOG, "r", encoding="utf-8", errors="ignore") as f:
-                lines = f.readlines()
-                for line in lines[-10:]:
-                    log(f"      {line.rstrip()}")
-            log("---------------------------------------")
-            log("")
+    status_after = daemon_status()
+    if status_before and status_after and status_after["pid"] == status_before["pid"]:
+        script_ran = status_after["runs"] > status_before["runs"]
+        last = status_after.get("last_run") or {}
+        log(f"      Daemon: {status_after['state']}, last run: {last.get('reason', '-')} -> "
+            f"{last.get('outcome') or 'no login'} in {last.get('ms', 0):.0f} ms")
+    else:
+        # No daemon to ask: a smaller file means the log rotated, which also means it was written to
+        script_ran = os.path.exists(LOGIN_LOG) and os.path.getsize(LOGIN_LOG) != log_size_before
+    if script_ran and os.path.exists(LOGIN_LOG):
+        log("--- Login script log (last entries) ---")
+        for line in login.tail(LOGIN_LOG, 10):
+            log(f"      {line.rstrip()}")
+        log("--- Recent events ---")
+        for record in login.recent_events(10):
+            ts = time.strftime("%H:%M:%S", time.localtime(record.pop("ts", 0)))
+            phase = record.pop("phase", "?")
+            log(f"      {ts} {phase:<12} " + " ".join(f"{k}={v}" for k, v in record.items()))
+        log("---------------------------------------")
+        log("")
 
     if success and script_ran:
         log("=== TEST PASSED ===")
@@ -0,0 +1,37 @@
+"""
+Offline checks of the login script's cached-verdict fast path (state.json).
+Run with:  python -m pytest windows-python
+"""
+
+import importlib.util
+import os
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_login(tmp_path):
+    spec = importlib.util.spec_from_file_location("nujs_wifi_login", os.path.join(SCRIPT_DIR, "nujs-wifi-login.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.STATE_FILE = str(tmp_path / "state.json")
+    return module
+
+
+def test_login_verdict_expires_with_the_session(tmp_path):
+    login = load_login(tmp_path)
+    cfg = {"session_timeout": 360}
+    login.save_state("login", "10.0.0.5", cfg, logged_in=True)
+    state = login.load_state()
+    state["login_at"] -= 400
+    assert login.state_is_fresh(state, "10.0.0.5", cfg) == "session TTL elapsed"
+
+
+def test_online_verdict_after_session_ttl_is_fresh(tmp_path):
+    # Logged in long ago; a probe has just found the internet working
+    login = load_login(tmp_path)
+    cfg = {"session_timeout": 360}
+    login.save_state("login", "10.0.0.5", cfg, logged_in=True)
+    login.update_state(login_at=time.time() - 3600)
+    login.save_state("online", "10.0.0.5", cfg)
+    assert login.state_is_fresh(login.load_state(), "10.0.0.5", cfg) is None
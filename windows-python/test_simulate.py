@@ -0,0 +1,40 @@
+"""
+Checks that simulate.py replays the login script's timing code faithfully.
+Run with:  python -m pytest windows-python
+"""
+
+import importlib.util
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_simulate():
+    spec = importlib.util.spec_from_file_location("simulate", os.path.join(SCRIPT_DIR, "simulate.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def episode(login_s):
+    # A run where the portal was up at once and answered the login POST in login_s
+    return {"t": 0.0, "race_s": 0.1, "online": False, "ready_at": 0.1, "refuse_s": 0.5, "connect_s": 0.005,
+            "probes": 3, "logins": [("LIVE", login_s)], "outcome": "login", "end": 10.0, "until": 10.0,
+            "drops": []}
+
+
+def test_slow_login_is_hedged():
+    sim = load_simulate()
+    # Typical logins take 0.2 s; in one the POST stalled for 3 s
+    r = sim.simulate([episode(0.2), episode(0.2), episode(3.0)], "current", {}, {}, 360, 1)
+    assert r["login"] == 4  # one each, plus the hedge in the slow run
+    hedge_after = sim.load_script(1).LOGIN_HEDGE_AFTER
+    # The hedge answered in the typical 0.2 s, well before the stalled POST
+    assert abs(r["to_internet"][-1] - (0.1 + hedge_after + 0.2)) < 1e-6
+
+
+def test_fast_login_is_not_hedged():
+    sim = load_simulate()
+    r = sim.simulate([episode(0.2)] * 3, "current", {}, {}, 360, 1)
+    assert r["login"] == 3
+    assert all(abs(t - 0.3) < 1e-6 for t in r["to_internet"])
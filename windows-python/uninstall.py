@@ -2,17 +2,20 @@
 Uninstall NUJS WiFi auto-login from Windows.
 """
 
+import json
 import subprocess
 import shutil
 import os
 
 TASK_NAME = "NUJS-WiFi-AutoLogin"
 INSTALL_DIR = r"C:\Scripts\nujs-wifi"
+CREDENTIAL_SERVICE = "nujs-wifi-autologin"
 
 
 def main():
     print("=== Uninstalling NUJS WiFi Auto-Login ===")
 
+    subprocess.run(["schtasks", "/End", "/TN", TASK_NAME], capture_output=True)
     result = subprocess.run(["schtasks", "/Delete", "/TN", TASK_NAME, "/F"],
                             capture_output=True, text=True)
     if result.returncode == 0:
@@ -20,6 +23,17 @@ def main():
     else:
         print("[*] No scheduled task found.")
 
+    # The password in Credential Manager, if setup put it there
+    try:
+        with open(os.path.join(INSTALL_DIR, "config.json")) as f:
+            username = json.load(f).get("username")
+    except Exception:
+        username = None
+    if username:
+        result = subprocess.run(["cmdkey", f"/delete:{CREDENTIAL_SERVICE}:{username}"], capture_output=True)
+        if result.returncode == 0:
+            print("[+] Saved password removed from Credential Manager.")
+
     if os.path.exists(INSTALL_DIR):
         shutil.rmtree(INSTALL_DIR, ignore_errors=True)
         print("[+] Script and config removed.")